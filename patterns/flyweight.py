@@ -25,6 +25,27 @@ python 本身是用 GC 机制的--当一个实例的引用计数为0时, GC 就
 所以弱引用的一个用处就是实现缓存! 当引用对象存在时, 则对象可用. 当对象不
 存在时, 返回 None, 程序不会因对象不存在而报错 -- 此乃有则用, 无则建的技术.
 
+*升级: 享元元类
+单靠 __new__ + WeakValueDictionary 还有两个毛病: 每个实例仍带着一个 __dict__,
+而且谁都能往共享的实例上挂属性, 所有持有者一起"中招". Flyweight 元类把这套做法
+抽出来: 任何类都能用, 按 key 函数驻留, 强制 __slots__, 属性只许 __init__ 写.
+
+*多线程
+"查一下没有就造" 不是原子的, 两个线程可能同时发现没有, 各造一个. 所以没命中时
+按 key 分段加锁, 锁里再查一次(single-flight); 命中时不加锁. __init__ 里又造享元
+(链表, 递归结构)时不再拿锁, 造好了再原子地放进池里, 晚到的那个扔掉, 免得自己锁死
+自己或者两个线程互等. 取值域有限(比如一副 52 张牌)的话, 干脆 preload() 全部预先造好.
+
+*再省一点: 按列存
+就算牌都是享元, 一个 list 里每个位置还是要 8 字节的指针, 而且每次处理都要碰
+Python 对象. 一副牌只有 52 种, 用一个字节的编码(享元表 CARDS 的下标)就够了:
+Hand/Hands 把牌存成 array('B'), 数花色/比较直接在字节串上做, 取牌时才查表变成 Card.
+
+*跨进程
+默认的 pickle 会把实例的状态原样带过去, 对面 unpickle 出来的是一个个新对象, 享元
+就白做了. 这里的享元 pickle 成 "类 + 构造参数", 对面 unpickle 时就是再调一次构造,
+自然落回对面进程的享元池. 整张享元表可以用 install_table 在 worker 启动时发一次.
+
 *同类作案手法
 - python ecosystem 下用了
 https://docs.python.org/3/library/sys.html#sys.intern
@@ -34,35 +55,338 @@ https://docs.python.org/3/library/sys.html#sys.intern
 """
 
 
+import pickle
+import random
+import sys
+import threading
+import time
+import tracemalloc
 import weakref
+from array import array
+
+
+class Flyweight(type):
+    """享元元类: 任何类套上它, 实例就按 key 驻留
+
+    - key 函数(类关键字参数 key=...)把构造参数映射成驻留用的键, 默认就是参数元组
+    - 强制 __slots__, 实例没有 __dict__, 每个实例省下一整个字典
+    - 属性只能在 __init__ 里写, 构造完就冻住, 之后改/删/加(包括 __init__ 没填的槽)
+      都抛 AttributeError,
+      免得某个持有者改了状态, 所有共享它的人都跟着变
+    - pickle 时只带构造参数, 到了另一个进程 unpickle 时重新走一遍驻留
+    """
+
+    def __new__(mcls, name, bases, namespace, key=None):
+        if '__slots__' not in namespace:
+            raise TypeError(f'flyweight class {name!r} must define __slots__ '
+                            f'naming the attributes __init__ sets')
+        slots = namespace['__slots__']
+        # 和 type 一样, 单个字符串就是一个槽名, 不能拆成一个个字符
+        slots = (slots,) if isinstance(slots, str) else tuple(slots)
+        # WeakValueDictionary 要能弱引用实例, 所以要给 __weakref__ 留个槽
+        if not any(hasattr(base, '__weakref__') for base in bases):
+            slots += ('__weakref__',)
+        # 记下构造参数, pickle 时只发这个
+        if not any(hasattr(base, '_flyweight_args') for base in bases):
+            slots += ('_flyweight_args',)
+        namespace['__slots__'] = slots
+        namespace.setdefault('__setattr__', _set_once)
+        namespace.setdefault('__delattr__', _no_delete)
+        namespace.setdefault('__reduce__', _reduce)
+        cls = super().__new__(mcls, name, bases, namespace)
+        cls._key = staticmethod(key) if key is not None else None
+        cls._pool = weakref.WeakValueDictionary()
+        cls._locks = [threading.Lock() for _ in range(_STRIPES)]
+        cls._pinned = []
+        return cls
+
+    def __call__(cls, *args, **kwargs):
+        if cls._key is not None:
+            key = cls._key(*args, **kwargs)
+        elif kwargs:
+            key = args + tuple(sorted(kwargs.items()))
+        else:
+            key = args
+        # 有则返回: 命中时不加锁
+        obj = cls._pool.get(key)
+        if obj is not None:
+            return obj
+        if getattr(_building, 'active', False):
+            # 嵌套构造(__init__ 里又造享元): 本线程已经拿着一把分段锁, 再去等别的锁
+            # 可能撞上自己(同一段)或者和别的线程互等, 所以不加锁直接造, 发布时谁先谁算数
+            return cls._publish(key, cls._build(args, kwargs))
+        # 无则创建: 按 key 的 hash 分段加锁, 锁里再查一次, 同一个 key 只会造一个
+        with cls._locks[hash(key) % _STRIPES]:
+            obj = cls._pool.get(key)
+            if obj is None:
+                _building.active = True
+                try:
+                    obj = cls._build(args, kwargs)
+                finally:
+                    _building.active = False
+                obj = cls._publish(key, obj)
+        return obj
+
+    def _build(cls, args, kwargs):
+        obj = super().__call__(*args, **kwargs)
+        # 多数享元只用位置参数, 这时只存 args 元组(往往就是 key 本身, 不多占内存);
+        # 有关键字参数才存成 [args, kwargs]
+        object.__setattr__(obj, '_flyweight_args', [args, kwargs] if kwargs else args)
+        return obj
+
+    def _publish(cls, key, obj):
+        """放进池里; 已经有人先放了就用先放的那个, 手里这个扔掉"""
+        with _publish_lock:
+            return cls._pool.setdefault(key, obj)
+
+    def preload(cls, domain):
+        """预先造好一个有限取值域里的所有实例(比如一副 52 张牌), 并一直持有,
+        之后的构造全都走不加锁的命中路径. domain 是一串构造参数元组."""
+        for args in domain:
+            cls._pinned.append(cls(*args))
+
+
+def _set_once(self, name, value):
+    # _build 等 __init__ 返回后才写 _flyweight_args, 写了就算冻住.
+    # 冻住之前是 __init__ 在赋值; 不是槽的名字 object 自己会拒绝
+    if not hasattr(self, '_flyweight_args') or not hasattr(type(self), name):
+        object.__setattr__(self, name, value)
+        return
+    raise AttributeError(f'{type(self).__name__} is a flyweight, {name!r} is read-only')
+
+
+def _no_delete(self, name):
+    raise AttributeError(f'{type(self).__name__} is a flyweight, {name!r} is read-only')
+
 
+def _reduce(self):
+    """pickle 成 "类 + 构造参数", 不带状态. copy/deepcopy 也因此拿回同一个实例"""
+    stored = self._flyweight_args
+    if type(stored) is list:
+        return _rebuild, (type(self), *stored)
+    return type(self), stored
 
-class Card:
+
+def _rebuild(cls, args, kwargs):
+    return cls(*args, **kwargs)
+
+
+def install_table(table):
+    """ProcessPoolExecutor(initializer=install_table, initargs=(CARDS,)) 用:
+    整张享元表每个 worker 只发一次, 在 worker 里驻留好并一直持有住, 之后任务里
+    再来的享元全都直接命中. fork 出来的 worker 拿到的是父进程的原对象(不经过
+    pickle), 所以这里照 unpickle 的路子再驻留一遍, 钉住的一定是池里的那个."""
+    for obj in table:
+        rebuild, args = obj.__reduce__()
+        type(obj)._pinned.append(rebuild(*args))
+
+
+# 分段锁的段数: 不同 key 的首次创建大多落在不同的锁上, 互不阻塞
+_STRIPES = 16
+# 本线程是不是正在某个享元的 __init__ 里
+_building = threading.local()
+# 往池里发布只在这把锁里做一次 setdefault, 锁里不跑用户代码, 不会互等
+_publish_lock = threading.Lock()
+
+VALUES = ('2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K', 'A')
+SUITS = ('s', 'h', 'd', 'c')
+
+
+class Card(metaclass=Flyweight):
     '''享元'''
 
-    # weakref.WeakValueDictionary([dict]) 创建value为弱引用对象的字典
+    # 元类帮忙: 按 (value, suit) 驻留, 没有 __dict__, 属性只读
+    # _pool 是 weakref.WeakValueDictionary, value 是弱引用,
     # 没有实例的时候, 就可以自动垃圾回收了
-    _pool = weakref.WeakValueDictionary()
-
-    def __new__(cls, value, suit):
-        # 有则返回
-        obj = cls._pool.get(value+suit)
-        # 无则创建
-        if obj is None:
-            obj = object.__new__(Card)
-            cls._pool[value+suit] = obj
-            # 其实干了 __init__ 里的活
-            obj.value, obj.suit = value, suit
-        return obj
+    __slots__ = ('value', 'suit')
 
-    # 如果这里放上
-    # def __init__(...)
-    #     obj.value, obj.suit = value, suit
-    # 不用 __new__(...) 那就变成传统的普通类了
+    def __init__(self, value, suit):
+        self.value, self.suit = value, suit
 
     def __repr__(self):
         return f'<Card: {self.value}{self.suit}>'
 
+    @property
+    def code(self):
+        """在享元表 CARDS 里的下标, 0..51, 一个字节就装得下"""
+        return _CODES[self.value, self.suit]
+
+
+# 享元表: 编码 -> Card. 整副牌常驻, 编码 = 点数序号 * 4 + 花色序号
+CARDS = tuple(Card(v, s) for v in VALUES for s in SUITS)
+_CODES = {(card.value, card.suit): code for code, card in enumerate(CARDS)}
+# bytes.translate 用的查表: 编码 -> 花色序号 / 点数序号, 整串一次在 C 里换完
+_SUIT_OF = bytes(code % len(SUITS) for code in range(256))
+_RANK_OF = bytes(code // len(SUITS) for code in range(256))
+
+
+class Hand:
+    """一手牌, 按列存: 每张牌只是 array('B') 里的一个字节(享元表里的编码).
+
+    只有按下标取牌/遍历时才落到 Card 对象上; 洗牌, 数花色, 比较都直接在
+    字节串上做, 数花色和比较是 C 层面的整串操作.
+    """
+
+    __slots__ = ('codes',)
+
+    def __init__(self, codes=()):
+        self.codes = array('B', codes)
+
+    @classmethod
+    def of(cls, *cards):
+        return cls(card.code for card in cards)
+
+    @classmethod
+    def deck(cls):
+        return cls(range(len(CARDS)))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return (CARDS[code] for code in self.codes)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return Hand(self.codes[i])
+        return CARDS[self.codes[i]]
+
+    def __eq__(self, other):
+        """同样的牌, 同样的顺序"""
+        return isinstance(other, Hand) and self.codes == other.codes
+
+    def same_cards(self, other):
+        """同样的牌, 不管顺序"""
+        return sorted(self.codes) == sorted(other.codes)
+
+    def shuffle(self, rng=random):
+        rng.shuffle(self.codes)
+
+    def deal(self, hands, size):
+        """从牌堆顶发 hands 手牌, 每手 size 张, 发出去的从牌堆里去掉"""
+        dealt = Hands(self.codes[:hands * size], size)
+        del self.codes[:hands * size]
+        return dealt
+
+    def count_by_suit(self):
+        suits = self.codes.tobytes().translate(_SUIT_OF)
+        return {suit: suits.count(i) for i, suit in enumerate(SUITS)}
+
+    def high_card(self):
+        return VALUES[max(self.codes.tobytes().translate(_RANK_OF))]
+
+    def __repr__(self):
+        return f'<Hand: {" ".join(card.value + card.suit for card in self)}>'
+
+
+class Hands:
+    """很多手等长的牌首尾相接放在一个 array('B') 里, 一百万手五张牌也就 5MB"""
+
+    __slots__ = ('codes', 'size')
+
+    def __init__(self, codes, size):
+        self.codes = array('B', codes)
+        self.size = size
+
+    @classmethod
+    def random(cls, count, size, rng=random):
+        """count 手牌, 每手都从一副新牌里随机抽 size 张"""
+        codes = array('B')
+        deck = range(len(CARDS))
+        for _ in range(count):
+            codes.extend(rng.sample(deck, size))
+        return cls(codes, size)
+
+    def __len__(self):
+        return len(self.codes) // self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Hand(self.codes[i * self.size:(i + 1) * self.size])
+
+    def suit_counts(self, suit):
+        """每手牌里某个花色的张数"""
+        mask = self.codes.tobytes().translate(_SUIT_OF)
+        target = bytes([SUITS.index(suit)])
+        size = self.size
+        return array('B', (mask.count(target, i, i + size) for i in range(0, len(mask), size)))
+
+    def flushes(self):
+        """同花(一手全是同一花色)的手数"""
+        suits = self.codes.tobytes().translate(_SUIT_OF)
+        size = self.size
+        return sum(suits.count(suits[i:i + 1], i, i + size) == size
+                   for i in range(0, len(suits), size))
+
+
+class _PlainCard:
+    """对照组: 同样是 __slots__, 但用默认的 pickle, 带着状态走"""
+
+    __slots__ = ('value', 'suit')
+
+    def __init__(self, value, suit):
+        self.value, self.suit = value, suit
+
+
+def _interned(cards):
+    """在 worker 里检查: install_table 钉住了几张牌, 收到的牌是不是就是那张表里的"""
+    pinned = {id(card) for card in Card._pinned}
+    return len(pinned), all(id(card) in pinned for card in cards)
+
+
+def bench_pickle(messages=2000, per_message=52):
+    """进程间传牌: 每张牌 pickle 出来多大, 接收方收完所有消息一共留下多少个对象"""
+    deck = [(v, s) for v in VALUES for s in SUITS]
+    for name, make in (('plain', _PlainCard), ('flyweight', Card)):
+        payloads = [pickle.dumps([make(*deck[(m + i) % 52]) for i in range(per_message)])
+                    for m in range(messages)]
+        tracemalloc.start()
+        received = [pickle.loads(payload) for payload in payloads]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        distinct = len({id(card) for cards in received for card in cards})
+        one = len(pickle.dumps(make('9', 'h')))
+        print(f'{name:>10}: {one} bytes/card alone, {sum(map(len, payloads)) / messages:.0f} '
+              f'bytes/message, receiver holds {distinct} objects, {size / 1024:.0f} KiB')
+    hand = Hand(range(per_message))
+    print(f'{"columnar":>10}: {len(pickle.dumps(hand))} bytes/message')
+
+
+def bench_memory(n=10 ** 6):
+    """tracemalloc 量一下: 10^6 个引用, 普通类 vs 享元"""
+
+    class PlainCard:
+        def __init__(self, value, suit):
+            self.value, self.suit = value, suit
+
+    deck = [(v, s) for v in VALUES for s in SUITS]
+
+    def measure(make):
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        held = [make(*deck[i % 52]) for i in range(n)]
+        took = time.perf_counter() - t0
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del held
+        return size, took
+
+    list_bytes = sys.getsizeof([None] * n)
+    for name, make in (('plain (__dict__)', PlainCard), ('flyweight (__slots__)', Card)):
+        size, took = measure(make)
+        print(f'{name:>22}: {size / n:6.1f} bytes/ref, '
+              f'{(size - list_bytes) / n:6.1f} bytes/ref beyond the list itself, {took:.2f}s')
+    tracemalloc.start()
+    codes = Hand(i % 52 for i in range(n))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del codes
+    print(f'{"columnar (uint8)":>22}: {size / n:6.1f} bytes/card')
+    plain = PlainCard('9', 'h')
+    print(f'one instance: plain {sys.getsizeof(plain) + sys.getsizeof(plain.__dict__)} bytes, '
+          f'flyweight {sys.getsizeof(Card("9", "h"))} bytes')
+
 
 def main():
     """
@@ -74,26 +398,131 @@ def main():
     >>> c1 == c2, c1 is c2
     (True, True)
 
+    # 以前可以往享元上挂新属性, 所有持有者都会看到; 现在加/改/删都不行
     >>> c1.new_attr = 'temp'
-    >>> c3 = Card('9', 'h')
-    >>> if hasattr(c3, 'new_attr'):
-    ...     print(c3.new_attr)
-    temp
+    Traceback (most recent call last):
+    ...
+    AttributeError: 'Card' object has no attribute 'new_attr'
+    >>> c1.value = '10'
+    Traceback (most recent call last):
+    ...
+    AttributeError: Card is a flyweight, 'value' is read-only
+    >>> hasattr(c1, '__dict__'), c1.value
+    (False, '9')
 
-    >>> print(c3.__dict__)
-    {'value': '9', 'suit': 'h', 'new_attr': 'temp'}
+    # __init__ 没填的槽, 构造完也不能再补
+    >>> class Glyph(metaclass=Flyweight):
+    ...     __slots__ = ('char', 'width')
+    ...     def __init__(self, char):
+    ...         self.char = char
+    >>> Glyph('x').width = 2
+    Traceback (most recent call last):
+    ...
+    AttributeError: Glyph is a flyweight, 'width' is read-only
 
     >>> Card._pool.clear()
     >>> c4 = Card('9', 'h')
-    >>> hasattr(c4, 'new_attr')
+    >>> c4 is c1
     False
 
-    >>> c4.__dict__
-    {'value': '9', 'suit': 'h'}
+    # 多线程同时第一次造同一张牌, 也只会有一个实例
+    >>> import threading
+    >>> start = threading.Barrier(8)
+    >>> made = []
+    >>> def draw():
+    ...     start.wait()
+    ...     made.append(Card('Q', 's'))
+    >>> threads = [threading.Thread(target=draw) for _ in range(8)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> len({id(card) for card in made})
+    1
+
+    # 预先造好整副牌, 之后全走不加锁的路径
+    >>> Card.preload((v, s) for v in VALUES for s in SUITS)
+    >>> len(Card._pool)
+    52
+
+    # 按列存的牌: 每张牌一个字节, 取出来才是 Card
+    >>> deck = Hand.deck()
+    >>> len(deck), deck.codes.itemsize, deck[0], deck[-1]
+    (52, 1, <Card: 2s>, <Card: Ac>)
+    >>> deck[0] is CARDS[0], deck[-1].code
+    (True, 51)
+    >>> deck.shuffle(random.Random(7))
+    >>> hands = deck.deal(4, 5)
+    >>> len(hands), len(deck)
+    (4, 32)
+    >>> sum(hands.suit_counts('h')) + deck.count_by_suit()['h']
+    13
+    >>> hand = Hand.of(Card('A', 'h'), Card('9', 'h'), Card('2', 'h'))
+    >>> hand.count_by_suit(), hand.high_card(), hand[1:]
+    ({'s': 0, 'h': 3, 'd': 0, 'c': 0}, 'A', <Hand: 9h 2h>)
+    >>> hand.same_cards(Hand.of(Card('2', 'h'), Card('A', 'h'), Card('9', 'h')))
+    True
+    >>> Hands(hand.codes, 3).flushes()
+    1
+
+    # pickle 只带 key, 在另一个进程里 unpickle 时重新驻留
+    >>> import pickle
+    >>> c5 = Card('9', 'h')
+    >>> pickle.loads(pickle.dumps(c5)) is c5
+    True
+    >>> from concurrent.futures import ProcessPoolExecutor
+    >>> Card._pinned.clear()   # 上面 preload 钉住的先放开(CARDS 还拿着它们), 免得 worker 继承过去
+    >>> with ProcessPoolExecutor(1, initializer=install_table, initargs=(CARDS,)) as executor:
+    ...     executor.submit(_interned, [c5, Card('A', 's')]).result()
+    (52, True)
+    >>> with ProcessPoolExecutor(1) as executor:
+    ...     executor.submit(_interned, [c5, Card('A', 's')]).result()
+    (0, False)
+    >>> class Glyph(metaclass=Flyweight):
+    ...     __slots__ = ('char', 'bold')
+    ...     def __init__(self, char, bold=False):
+    ...         self.char, self.bold = char, bold
+    >>> Glyph('a')._flyweight_args, Glyph('a', bold=True)._flyweight_args
+    (('a',), [('a',), {'bold': True}])
+    >>> import copy
+    >>> copy.deepcopy(Glyph('a', bold=True)) is Glyph('a', bold=True)
+    True
+
+    # 任何类都能套元类, key 函数决定哪些实例算"同一个"
+    >>> class Color(metaclass=Flyweight, key=lambda name: name.lower()):
+    ...     __slots__ = ('name',)
+    ...     def __init__(self, name):
+    ...         self.name = name.lower()
+    >>> Color('Red') is Color('RED'), Color('red').name
+    (True, 'red')
+
+    # 嵌套构造: __init__ 里再造同一个类的享元, 不会自己锁死自己
+    >>> class Chain(metaclass=Flyweight):
+    ...     __slots__ = ('n', 'prev')
+    ...     def __init__(self, n):
+    ...         self.n, self.prev = n, Chain(n - 1) if n else None
+    >>> chain = Chain(40)
+    >>> chain.prev.prev is Chain(38), Chain(0).prev
+    (True, None)
 
+    # __slots__ 写成一个字符串也行; 不写 __slots__ 在建类时就报错
+    >>> class Shade(metaclass=Flyweight):
+    ...     __slots__ = 'name'
+    ...     def __init__(self, name):
+    ...         self.name = name
+    >>> Shade('dark').name
+    'dark'
+    >>> class Tint(metaclass=Flyweight):
+    ...     def __init__(self, name):
+    ...         self.name = name
+    Traceback (most recent call last):
+    ...
+    TypeError: flyweight class 'Tint' must define __slots__ naming the attributes __init__ sets
     """
 
 
 if __name__ == "__main__":
-    import doctest
-    doctest.testmod(verbose=True)
+    if '--bench' in sys.argv:
+        bench_memory()
+        bench_pickle()
+    else:
+        import doctest
+        doctest.testmod(verbose=True)
@@ -3,6 +3,8 @@
 *图搜索
 DFS = 深度优先(Depth First Search). 不撞南墙不回头, 能够快速找到一条路径,
 但通常不是最优路径. DFS 用栈来存放数据.
+这里的 DFS 都用显式栈实现, 不递归, 图再深也不会撞上 recursion limit; 回溯时共用
+一条 path, 用集合判断节点是否已在路径上, 不再每步复制 path[:].
 
 BFS = 广度优先(Breadth First Search). 呈波浪状推进, 以时间换空间,
 能找到最优解, 为能够波浪状搜索, 采用队列(Queue)作为 openlist 的数据结构.
@@ -22,78 +24,1387 @@ e <--- g   h
 
 ps 这里的例子特别简略, 只能算是示意. 用于有权重路径的算法, 需要用 GBFS, Dijkstra, A*
 等其他启发式搜索算法.
+
+*带权最短路
+Dijkstra 用小根堆(heapq)每次取出离起点最近的节点. A* 在堆的优先级上再加一个
+"到终点距离"的下界估计 h, 估得越准, 绕的远路越少. 没有现成的几何下界时, 可以用
+ALT: 预先选几个地标, 算好所有点到地标的距离, 用三角不等式给出 h.
+
+*双向 BFS
+单向 BFS 的搜索范围是以起点为圆心的一整个"圆", 分支因子为 b, 距离为 d 时要访问
+约 b^d 个节点. 从起点和终点同时出发(终点那边走反向图), 两个半径 d/2 的圆相遇即可,
+只需约 2*b^(d/2) 个节点.
+
+*强连通分量
+互相能走到的一组节点叫强连通分量(SCC). 把每个 SCC 缩成一个点, 剩下的就是 DAG,
+找环/判可达不必再枚举所有路径(那是指数级的), 线性时间就够了.
+
+*可达性
+只问"能不能到"的时候不必找路径. 先把强连通分量(SCC)缩成一个点, 缩完是个 DAG,
+再给每个分量记一张"能到哪些分量"的位图, 查询就是查一位.
+
+*磁盘上的图
+图大到 dict 装不下时, 把 CSR 原样写进文件(头部, offsets, targets, 标签表),
+用 mmap 打开后直接在文件上搜, 启动只需读个文件头. 文本边表可以用
+convert_edge_list() 流式转换, 不必先在内存里拼出 dict.
+
+*CSR 紧凑存储
+dict-of-lists 每条边都要存一个标签引用, 每走一步都要 hash 一次标签. 节点多了以后
+内存和速度都吃不消. GraphSearch 在第一次查找时会把 graph 编译成 CompactGraph:
+标签驻留成 0..n-1 的整数, 出边按起点依次排进 targets, offsets[v] 记录 v 的出边
+从哪开始. 所有 find_* 都在整数上跑, 最后再把结果翻译回原来的标签.
 """
 
+import functools
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heappop, heappush
+from multiprocessing import shared_memory
 
-class GraphSearch:
-    def __init__(self, graph):
+
+class CompactGraph:
+    """CSR (Compressed Sparse Row) 形式的邻接表
+
+    节点标签先驻留(intern)成连续的整数 id, 出边都挤在一个 array('i') 里.
+    节点 v 的邻居是 targets[offsets[v]:offsets[v + 1]], 每条边只占 4 字节,
+    遍历的时候也不用再对字符串做 hash.
+    """
+
+    __slots__ = ('labels', 'index', 'offsets', 'targets', '_mapped')
+
+    def __init__(self, labels, offsets, targets, index=None):
+        self._mapped = None  # open() 出来的: (mmap, 指向它的 memoryview 们), close() 用
+        self.labels = labels
+        if index is None:
+            index = {label: i for i, label in enumerate(labels)}
+        self.index = index
+        self.offsets = offsets
+        self.targets = targets
+
+    @classmethod
+    def from_dict(cls, graph):
+        # 先给所有起点编号, 只出现在边终点上的节点排在后面, 出度为 0
+        labels = list(graph)
+        index = {label: i for i, label in enumerate(labels)}
+        offsets = array('i', [0])
+        targets = array('i')
+        for neighbours in graph.values():
+            for neighbour in neighbours:
+                i = index.get(neighbour)
+                if i is None:
+                    i = index[neighbour] = len(labels)
+                    labels.append(neighbour)
+                targets.append(i)
+            offsets.append(len(targets))
+        offsets.extend([len(targets)] * (len(labels) - len(graph)))
+        return cls(labels, offsets, targets, index)
+
+    def reverse(self):
+        """反向图(所有边掉头), 计数排序一遍搞定, 标签表和原图共用"""
+        roffsets, rtargets, _ = self._transpose()
+        return CompactGraph(self.labels, roffsets, rtargets, self.index)
+
+    def reverse_weights(self, weights):
+        """和 targets 对齐的边权, 换成和 reverse().targets 对齐"""
+        return self._transpose(weights)[2]
+
+    def _transpose(self, weights=None):
+        n = len(self.labels)
+        offsets, targets = self.offsets, self.targets
+        roffsets = array('i', [0]) * (n + 1)
+        for t in targets:
+            roffsets[t + 1] += 1
+        for v in range(n):
+            roffsets[v + 1] += roffsets[v]
+        rtargets = array('i', [0]) * len(targets)
+        rweights = None if weights is None else array('d', [0.0]) * len(targets)
+        fill = roffsets[:-1]
+        for v in range(n):
+            for i in range(offsets[v], offsets[v + 1]):
+                t = targets[i]
+                rtargets[fill[t]] = v
+                if rweights is not None:
+                    rweights[fill[t]] = weights[i]
+                fill[t] += 1
+        return roffsets, rtargets, rweights
+
+    def weights_from(self, weights, default=1):
+        """把 {(u, v): w} 的边权编译成和 targets 对齐的 array('d')"""
+        labels, offsets, targets = self.labels, self.offsets, self.targets
+        out = array('d', [0.0]) * len(targets)
+        for v in range(len(labels)):
+            for i in range(offsets[v], offsets[v + 1]):
+                w = weights.get((labels[v], labels[targets[i]]), default)
+                if w < 0:
+                    raise ValueError(f'negative weight on edge {labels[v]!r} -> {labels[targets[i]]!r}')
+                out[i] = w
+        return out
+
+    def __len__(self):
+        return len(self.labels)
+
+    def id_of(self, label):
+        return self.index.get(label)
+
+    def neighbours(self, v):
+        return self.targets[self.offsets[v]:self.offsets[v + 1]]
+
+    def save(self, path):
+        """按 GSCSR 格式写盘, 之后可以用 CompactGraph.open() 直接 mmap 回来.
+        文件里的标签是 utf-8 字节串, 所以只支持 str 标签(int 之类先转成 str)"""
+        for label in self.labels:
+            if not isinstance(label, str):
+                raise TypeError(f'GSCSR files only store str labels, got {label!r}')
+        encoded = [label.encode() for label in self.labels]
+        with open(path, 'wb') as f:
+            _write_graph(f, encoded, len(self.targets),
+                         array('i', self.offsets), array('i', self.targets))
+
+    @classmethod
+    def open(cls, path):
+        """mmap 打开 GSCSR 文件, 不读进内存, 用到哪页操作系统才加载哪页.
+
+        offsets/targets 是直接指向文件的 memoryview, 标签按需解码,
+        按标签查 id 走文件里排好序的 order 表做二分.
+        用完 close(), 或者放进 with 语句.
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(mm)
+        views = [buf]
+
+        def section(start, end, code=None):
+            view = buf[start:end]
+            views.append(view)
+            if code is None:
+                return view
+            if sys.byteorder == 'little':
+                view = view.cast(code)
+                views.append(view)
+                return view
+            # 文件是小端的, 大端机器上只能拷出来换字节序, 这一段就不是零拷贝了
+            data = array(code)
+            data.frombytes(view)
+            data.byteswap()
+            return data
+
+        magic, n, m, blob_size = _HEADER.unpack_from(buf)
+        if magic != _MAGIC:
+            buf.release()
+            mm.close()
+            raise ValueError(f'{path}: not a GSCSR graph file')
+        at = _layout(n, m, blob_size)
+        labels = _LabelTable(section(at['positions'], at['blob'], 'q'),
+                             section(at['blob'], at['end']))
+        index = _LabelIndex(labels, section(at['order'], at['order'] + 4 * n, 'i'))
+        graph = cls(labels, section(at['offsets'], at['targets'], 'i'),
+                    section(at['targets'], at['order'], 'i'), index)
+        graph._mapped = (mm, views)
+        return graph
+
+    def close(self):
+        """open() 出来的图: 放开所有指向文件的 memoryview, 关掉 mmap. 之后不能再用"""
+        if self._mapped is None:
+            return
+        mm, views = self._mapped
+        self._mapped = None
+        for view in reversed(views):
+            view.release()
+        mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# GSCSR 文件格式, 全部小端(大端机器上写盘前, 读盘后都换一次字节序):
+#   header    magic, 节点数 n, 边数 m, 标签总字节数
+#   offsets   int32 * (n + 1)
+#   targets   int32 * m
+#   order     int32 * n       按标签字节序排好的节点 id, 二分查标签用
+#   (补齐到 8 字节)
+#   positions int64 * (n + 1) 第 v 个标签在 blob 里的起止
+#   blob      utf-8 标签依次拼接(所以标签只能是 str)
+_MAGIC = b'GSCSR001'
+_HEADER = struct.Struct('<8sqqq')
+
+
+def _layout(n, m, blob_size):
+    at = {'offsets': _HEADER.size}
+    at['targets'] = at['offsets'] + 4 * (n + 1)
+    at['order'] = at['targets'] + 4 * m
+    at['positions'] = (at['order'] + 4 * n + 7) & ~7
+    at['blob'] = at['positions'] + 8 * (n + 1)
+    at['end'] = at['blob'] + blob_size
+    return at
+
+
+def _little_endian(data):
+    """array -> 小端字节串"""
+    if sys.byteorder == 'big':
+        data = array(data.typecode, data)
+        data.byteswap()
+    return data.tobytes()
+
+
+def _write_graph(f, encoded, m, offsets=None, targets=None):
+    """写出整个文件; offsets/targets 为 None 时只留出位置(由调用方就地填)"""
+    n = len(encoded)
+    positions = array('q', [0])
+    for raw in encoded:
+        positions.append(positions[-1] + len(raw))
+    at = _layout(n, m, positions[-1])
+    order = array('i', sorted(range(n), key=encoded.__getitem__))
+
+    f.write(_HEADER.pack(_MAGIC, n, m, positions[-1]))
+    if offsets is not None:
+        f.write(_little_endian(offsets))
+        f.write(_little_endian(targets))
+    f.seek(at['order'])
+    f.write(_little_endian(order))
+    f.seek(at['positions'])
+    f.write(_little_endian(positions))
+    for raw in encoded:
+        f.write(raw)
+
+
+class _LabelTable:
+    """只读的标签序列, 按下标从 blob 里切出来再解码"""
+
+    __slots__ = ('positions', 'blob')
+
+    def __init__(self, positions, blob):
+        self.positions = positions
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.positions) - 1
+
+    def __getitem__(self, v):
+        return self.raw(v).decode()
+
+    def raw(self, v):
+        return bytes(self.blob[self.positions[v]:self.positions[v + 1]])
+
+
+class _LabelIndex:
+    """代替 label -> id 的 dict: 在排好序的 order 表上二分"""
+
+    __slots__ = ('labels', 'order')
+
+    def __init__(self, labels, order):
+        self.labels = labels
+        self.order = order
+
+    def get(self, label, default=None):
+        if not isinstance(label, str):
+            raise TypeError(f'GSCSR graphs have str labels, got {label!r}')
+        raw = label.encode()
+        i = bisect_left(self.order, raw, key=self.labels.raw)
+        if i < len(self.order) and self.labels.raw(self.order[i]) == raw:
+            return self.order[i]
+        return default
+
+
+def convert_edge_list(src, dst):
+    """把文本边表(每行 "u v", 空行和 # 注释跳过)流式转成 GSCSR 文件.
+
+    过两遍 src: 第一遍给标签编号并统计出度, 第二遍把每条边的终点直接写进
+    mmap 出来的 dst 里. 内存里只有标签表和每个节点一个游标, 边不进内存.
+    只有一列的行表示孤立节点. 返回 (节点数, 边数).
+    """
+    index = {}
+    encoded = []
+    degree = array('q')
+
+    def intern(label):
+        v = index.get(label)
+        if v is None:
+            v = index[label] = len(encoded)
+            encoded.append(label.encode())
+            degree.append(0)
+        return v
+
+    for fields in _edge_lines(src):
+        u = intern(fields[0])
+        if len(fields) > 1:
+            intern(fields[1])
+            degree[u] += 1
+
+    n = len(encoded)
+    offsets = array('i', [0])
+    for d in degree:
+        offsets.append(offsets[-1] + d)
+    m = offsets[-1]
+
+    with open(dst, 'w+b') as f:
+        _write_graph(f, encoded, m)
+        f.flush()
+        at = _layout(n, m, 0)
+        with mmap.mmap(f.fileno(), 0) as mm:
+            mm[at['offsets']:at['targets']] = _little_endian(offsets)
+            with memoryview(mm) as buf, buf[at['targets']:at['order']].cast('i') as targets:
+                cursor = offsets[:-1]
+                for fields in _edge_lines(src):
+                    if len(fields) > 1:
+                        u = index[fields[0]]
+                        targets[cursor[u]] = index[fields[1]]
+                        cursor[u] += 1
+            if sys.byteorder == 'big':
+                # 上面是按本机字节序就地写的, 最后整段换成小端
+                mm[at['targets']:at['order']] = _little_endian(
+                    array('i', mm[at['targets']:at['order']]))
+    return n, m
+
+
+def _edge_lines(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            fields = line.split()
+            if fields and not fields[0].startswith('#'):
+                yield fields
+
+
+class ReachabilityIndex:
+    """可达性索引: SCC 缩点 + 位图传递闭包.
+
+    同一个强连通分量里的点互相可达, 所以只要给每个分量记一个位图 reach[c],
+    第 d 位为 1 表示分量 c 能到分量 d. 查询就是一次移位加按位与.
+    边的增删在标签空间里增量维护, 不用每次从头重建: 加边只往回走能到 u 的分量,
+    已经能到 v 的就不再往上走; 删边只重算能到 u 的那些分量.
+
+    位图一共要 C^2/8 字节(C 是分量数): 1.6 万个分量 32MB, 10 万个就 1.2GB.
+    分量数超过 max_components 时不建位图, 退回到在缩点后的 DAG 上搜: 分量按逆拓扑序
+    编号, 编号比 b 小的分量走不到 b, 直接剪掉.
+    """
+
+    MAX_COMPONENTS = 1 << 14
+
+    def __init__(self, graph, max_components=MAX_COMPONENTS, csr=None):
+        """csr: 已经编译好的 graph(或者 mmap 打开的图, 这时 graph 是 None, 不能改边)"""
         self.graph = graph
+        self.max_components = max_components
+        self._rebuild(csr)
 
-    def find_path_dfs(self, start, end, path=None):
-        path = path or []
-        path.append(start)
+    def _rebuild(self, csr=None):
+        if csr is None:
+            csr = CompactGraph.from_dict(self.graph)
+        comp, count = _tarjan_scc(csr.offsets, csr.targets)
+        self.comp = {label: comp[v] for v, label in enumerate(csr.labels)}
+        self.members = [[] for _ in range(count)]
+        for label, c in self.comp.items():
+            self.members[c].append(label)
+        # succ[c] = {d: c 到 d 的边数}, 删边时靠计数判断分量间是否还连着; pred 反过来
+        self.succ = [{} for _ in range(count)]
+        self.pred = [{} for _ in range(count)]
+        offsets, targets = csr.offsets, csr.targets
+        for v in range(len(csr)):
+            cv = comp[v]
+            for i in range(offsets[v], offsets[v + 1]):
+                ct = comp[targets[i]]
+                if ct != cv:
+                    self.succ[cv][ct] = self.succ[cv].get(ct, 0) + 1
+                    self.pred[ct][cv] = self.pred[ct].get(cv, 0) + 1
+        # 分量间的边是否都从大编号指向小编号; 加边破坏了这个顺序就不能按编号剪枝
+        self._ordered = True
+        if count > self.max_components:
+            self.reach = None
+            return
+        # Tarjan 先吐出汇点所在的分量, 按编号从小到大算, 后继一定已经算好
+        self.reach = reach = [0] * count
+        for c in range(count):
+            r = 1 << c
+            for d in self.succ[c]:
+                r |= reach[d]
+            reach[c] = r
 
-        if start == end:
+    def is_reachable(self, a, b):
+        if a == b:
+            return True
+        ca, cb = self.comp.get(a), self.comp.get(b)
+        if ca is None or cb is None:
+            return False
+        if self.reach is not None:
+            return self.reach[ca] >> cb & 1 == 1
+        return self._search(ca, cb)
+
+    def _search(self, ca, cb):
+        """没有位图时在缩点 DAG 上 DFS"""
+        if ca == cb:
+            return True
+        ordered = self._ordered
+        if ordered and cb > ca:
+            return False
+        seen = {ca}
+        todo = [ca]
+        while todo:
+            for d in self.succ[todo.pop()]:
+                if d == cb:
+                    return True
+                if d not in seen and (d > cb or not ordered):
+                    seen.add(d)
+                    todo.append(d)
+        return False
+
+    def _component(self, label):
+        c = self.comp.get(label)
+        if c is None:
+            c = self.comp[label] = len(self.succ)
+            self.members.append([label])
+            self.succ.append({})
+            self.pred.append({})
+            if self.reach is not None:
+                if c >= self.max_components:
+                    self.reach = None
+                else:
+                    self.reach.append(1 << c)
+        return c
+
+    def _ancestors(self, c):
+        """能走到分量 c 的所有分量(含 c 自己)"""
+        seen = {c}
+        todo = [c]
+        while todo:
+            for x in self.pred[todo.pop()]:
+                if x not in seen:
+                    seen.add(x)
+                    todo.append(x)
+        return seen
+
+    def add_edge(self, u, v):
+        """graph 里已经加上 u -> v 之后调用"""
+        cu, cv = self._component(u), self._component(v)
+        if cu == cv:
+            return
+        self.succ[cu][cv] = self.succ[cu].get(cv, 0) + 1
+        self.pred[cv][cu] = self.pred[cv].get(cu, 0) + 1
+        if cv > cu:
+            self._ordered = False
+        reach = self.reach
+        if reach is None or reach[cu] >> cv & 1:
+            return
+        # 能到 u 的分量, 现在也能到 v 能到的一切. 往回走, 已经全能到的分量不再往上走:
+        # 它的祖先的 reach 包含它的 reach, 也早就全能到了
+        rv = reach[cv]
+        reach[cu] |= rv
+        todo = [cu]
+        while todo:
+            for x in self.pred[todo.pop()]:
+                if reach[x] | rv != reach[x]:
+                    reach[x] |= rv
+                    todo.append(x)
+
+    def remove_edge(self, u, v):
+        """graph 里已经删掉 u -> v 之后调用"""
+        cu, cv = self.comp[u], self.comp[v]
+        if cu == cv:
+            # 分量内部的边: u 还能在分量内走到 v 就什么都没变, 否则分量裂开, 重建
+            if not self._reaches_within(u, v, cu):
+                self._rebuild()
+            return
+
+        succ, pred = self.succ[cu], self.pred[cv]
+        succ[cv] -= 1
+        pred[cu] -= 1
+        if succ[cv]:
+            return
+        del succ[cv], pred[cu]
+        reach = self.reach
+        if reach is None:
+            return
+
+        # 只有能到 cu 的分量可能受影响; 其余分量的 reach 仍然可信, 遇到直接并入
+        affected = self._ancestors(cu)
+        fresh = {}
+        for x in affected:
+            r = 1 << x
+            seen = {x}
+            todo = [x]
+            while todo:
+                for d in self.succ[todo.pop()]:
+                    if d in seen:
+                        continue
+                    seen.add(d)
+                    if d in affected:
+                        r |= 1 << d
+                        todo.append(d)
+                    else:
+                        r |= reach[d]
+            fresh[x] = r
+        for x, r in fresh.items():
+            reach[x] = r
+
+    def _reaches_within(self, u, v, c):
+        comp, graph = self.comp, self.graph
+        seen = {u}
+        todo = [u]
+        while todo:
+            for node in graph.get(todo.pop(), []):
+                if node == v:
+                    return True
+                if node not in seen and comp.get(node) == c:
+                    seen.add(node)
+                    todo.append(node)
+        return False
+
+
+class PathCache:
+    """有界 LRU 结果缓存, 带图版本号.
+
+    图每改一次版本号加一, 查缓存时版本对不上就整个清空, 不用逐条判断失效.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.version = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._data = OrderedDict()
+
+    def get(self, key, version):
+        if version != self.version:
+            if self._data:
+                self._data.clear()
+                self.invalidations += 1
+            self.version = version
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+_MISSING = object()
+
+
+def _cached_query(method):
+    """给 (start, end) -> path 的查询套上 PathCache; 缓存里存 tuple, 取出再转 list"""
+
+    @functools.wraps(method)
+    def wrapper(self, start, end):
+        cache = self._cache
+        if cache is None:
+            return method(self, start, end)
+        if self.graph is not None:
+            self.csr  # 先把 CSR 建好, build() 会改 version
+        key = (method.__name__, start, end)
+        path = cache.get(key, self.version)
+        if path is _MISSING:
+            path = method(self, start, end)
+            cache.put(key, None if path is None else tuple(path))
             return path
+        return None if path is None else list(path)
+
+    return wrapper
+
+
+class GraphSearch:
+    def __init__(self, graph, cache_size=None):
+        """cache_size 不为 None 时, find_shortest_path_bfs / find_path_dfs 的结果
+        放进这么大的 LRU 缓存, 图经 add_edge/remove_edge/build 改动后自动失效"""
+        self.graph = graph
+        self.version = 0
+        self._cache = None if cache_size is None else PathCache(cache_size)
+        self._csr = None
+        self._rcsr = None
+        self._weights = None
+        self._landmarks = None
+        self._reach = None
+
+    def build(self):
+        """把 self.graph 编译成 CompactGraph, 之后的查找都在它上面跑.
+        直接改了 graph 后需要重新 build(), 可达性索引也跟着作废重建."""
+        self.version += 1
+        self._reach = None
+        return self._compile()
+
+    def _compile(self):
+        """只重新编译 CSR. add_edge/remove_edge 之后第一次查找走这里,
+        可达性索引已经增量更新过了, 留着"""
+        self._csr = CompactGraph.from_dict(self.graph)
+        self._rcsr = None
+        self._weights = None
+        self._landmarks = None
+        return self._csr
+
+    @classmethod
+    def open(cls, path):
+        """直接在 mmap 的 GSCSR 文件上搜索, 没有 graph dict, 只读"""
+        graph_search = cls(None)
+        graph_search._csr = CompactGraph.open(path)
+        return graph_search
+
+    @property
+    def csr(self):
+        if self._csr is None:
+            self._compile()
+        return self._csr
+
+    @property
+    def rcsr(self):
+        """反向邻接表, 双向搜索时才用得到, 所以第一次用的时候再建"""
+        if self._rcsr is None:
+            self._rcsr = self.csr.reverse()
+        return self._rcsr
+
+    def add_edge(self, u, v):
+        """加一条边 u -> v. 编译好的 CSR 作废, 可达性索引增量更新"""
+        self.graph.setdefault(u, []).append(v)
+        self.version += 1
+        self._csr = None
+        if self._reach is not None:
+            self._reach.add_edge(u, v)
+
+    def remove_edge(self, u, v):
+        """删一条边 u -> v (有重边只删一条)"""
+        self.graph[u].remove(v)
+        self.version += 1
+        self._csr = None
+        if self._reach is not None:
+            self._reach.remove_edge(u, v)
+
+    def is_reachable(self, start, end):
+        """start 能否走到 end. 第一次调用时建可达性索引, 之后近似 O(1)"""
+        if self._reach is None:
+            self._reach = ReachabilityIndex(self.graph, csr=self.csr)
+        return self._reach.is_reachable(start, end)
+
+    def strongly_connected_components(self):
+        """强连通分量, 非递归 Tarjan, O(V + E).
+
+        按缩点 DAG 的拓扑序排列: 分量 i 有边连到分量 j 时, 一定 i < j.
+        每个分量是一组标签.
+        """
+        comp, count = self._topological_components()
+        labels = self.csr.labels
+        components = [[] for _ in range(count)]
+        for v in range(len(comp)):
+            components[comp[v]].append(labels[v])
+        return components
+
+    def condensation(self):
+        """缩点: 每个强连通分量缩成一个点, 得到一个 DAG.
+
+        返回 (comp, dag). comp[label] 是所在分量的编号, 编号即拓扑序
+        (和 strongly_connected_components() 的下标一致); dag 是以编号为标签的
+        CompactGraph, 重边已去掉, 可以直接喂给按拓扑序松弛的 DAG 最短路.
+        """
+        csr = self.csr
+        comp, count = self._topological_components()
+        offsets, targets = csr.offsets, csr.targets
+        n = len(comp)
+
+        # 按分量把节点排好(计数排序), 再逐个分量收集出边, 用 stamp 去重
+        start = array('i', [0]) * (count + 1)
+        for v in range(n):
+            start[comp[v] + 1] += 1
+        for c in range(count):
+            start[c + 1] += start[c]
+        members = array('i', [0]) * n
+        fill = start[:-1]
+        for v in range(n):
+            members[fill[comp[v]]] = v
+            fill[comp[v]] += 1
+
+        stamp = array('i', [-1]) * count
+        dag_offsets = array('i', [0])
+        dag_targets = array('i')
+        for c in range(count):
+            for k in range(start[c], start[c + 1]):
+                v = members[k]
+                for i in range(offsets[v], offsets[v + 1]):
+                    d = comp[targets[i]]
+                    if d != c and stamp[d] != c:
+                        stamp[d] = c
+                        dag_targets.append(d)
+            dag_offsets.append(len(dag_targets))
+
+        labels = csr.labels
+        comp_of = {labels[v]: comp[v] for v in range(n)}
+        return comp_of, CompactGraph(list(range(count)), dag_offsets, dag_targets)
+
+    def _topological_components(self):
+        """Tarjan 的分量编号是逆拓扑序, 这里翻过来"""
+        csr = self.csr
+        comp, count = _tarjan_scc(csr.offsets, csr.targets)
+        last = count - 1
+        for v in range(len(comp)):
+            comp[v] = last - comp[v]
+        return comp, count
+
+    def cache_info(self):
+        """命中/未命中/淘汰/失效 计数, 没开缓存时返回 None"""
+        return None if self._cache is None else self._cache.info()
+
+    def _to_labels(self, ids):
+        labels = self.csr.labels
+        return [labels[i] for i in ids]
 
-        for node in self.graph.get(start, []):
-            if node not in path:
-                newpath = self.find_path_dfs(node, end, path[:])
-                if newpath:
-                    return newpath
+    @_cached_query
+    def find_path_dfs(self, start, end):
+        if start == end:
+            return [start]
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return None
 
-    def find_all_paths_dfs(self, start, end, path=None):
-        path = path or []
-        path.append(start)
+        # 只要一条路径: 走过且没找到 end 的节点不必再进, 用全局 visited 即可
+        offsets, targets = csr.offsets, csr.targets
+        path = [s]
+        cursor = [offsets[s]]  # cursor[k] 是 path[k] 下一条待走的出边
+        visited = {s}
+        while path:
+            v = path[-1]
+            i = cursor[-1]
+            if i == offsets[v + 1]:
+                path.pop()
+                cursor.pop()
+                continue
+            cursor[-1] = i + 1
+            node = targets[i]
+            if node == e:
+                path.append(node)
+                return self._to_labels(path)
+            if node not in visited:
+                visited.add(node)
+                path.append(node)
+                cursor.append(offsets[node])
+        return None
 
+    def find_all_paths_dfs(self, start, end):
+        """惰性生成所有简单路径, 调用方可以随时停下"""
         if start == end:
-            return [path]
+            yield [start]
+            return
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return
+        for path in self._iter_paths(s, e):
+            yield self._to_labels(path)
 
-        paths = []
-        for node in self.graph.get(start, []):
-            if node not in path:
-                newpaths = self.find_all_paths_dfs(node, end, path[:])
-                paths.extend(newpaths)
-        return paths
+    def _iter_paths(self, s, e, limit=None):
+        """显式栈回溯, 全程共用一条 path, on_path 集合判断是否成环.
 
-    def find_shortest_path_dfs(self, start, end, path=None):
-        path = path or []
-        path.append(start)
+        limit 不为 None 时, 只产出比 limit 更短的路径, 超长分支直接剪掉.
+        """
+        csr = self.csr
+        offsets, targets = csr.offsets, csr.targets
+        path = [s]
+        cursor = [offsets[s]]
+        on_path = {s}
+        while path:
+            v = path[-1]
+            i = cursor[-1]
+            if i == offsets[v + 1]:
+                on_path.discard(path.pop())
+                cursor.pop()
+                continue
+            cursor[-1] = i + 1
+            node = targets[i]
+            if node in on_path:
+                continue
+            if node == e:
+                path.append(node)
+                yield path
+                path.pop()
+                if limit is not None:
+                    limit = len(path) + 1
+            elif limit is None or len(path) + 2 < limit:
+                on_path.add(node)
+                path.append(node)
+                cursor.append(offsets[node])
 
+    def find_shortest_path_dfs(self, start, end):
         if start == end:
-            return path
+            return [start]
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return None
 
+        # 每找到一条更短的, limit 跟着收紧, 不比它短的分支不再展开
         shortest = None
-        for node in self.graph.get(start, []):
-            if node not in path:
-                newpath = self.find_shortest_path_dfs(node, end, path[:])
-                if newpath and (not shortest or len(newpath) < len(shortest)):
-                    shortest = newpath
-        return shortest
+        for path in self._iter_paths(s, e, limit=len(csr) + 1):
+            shortest = path[:]
+        return self._to_labels(shortest) if shortest else None
 
+    @_cached_query
     def find_shortest_path_bfs(self, start, end):
-        queue = [start]
-        dist_to = {start: 0}
+        if start == end:
+            return [start]
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return None
+
+        offsets, targets = csr.offsets, csr.targets
+        queue = deque([s])
+        dist_to = {s: 0}
         edge_to = {}
 
+        while queue:
+            value = queue.popleft()
+            for i in range(offsets[value], offsets[value + 1]):
+                node = targets[i]
+                if node not in dist_to:  #dist_to s  dist_to.keys() 的简写
+                    edge_to[node] = value
+                    dist_to[node] = dist_to[value] + 1
+                    if node == e:
+                        return self._to_labels(self._walk_back(edge_to, s, e))
+                    queue.append(node)
+
+    def find_shortest_paths_bfs(self, queries):
+        """批量查询. queries 是一串 (start, end), 按起点分组, 每个起点只跑一次 BFS.
+
+        所有终点共用同一棵 dist_to/edge_to 树, 终点都找到了就提前收工.
+        结果按起点分组逐个产出 (start, end, path), path 和
+        find_shortest_path_bfs 的返回一致.
+        """
+        csr = self.csr
+        for start, ends in _group_by_source(queries).items():
+            s = csr.id_of(start)
+            ids = [csr.id_of(end) for end in ends]
+            if s is None:
+                paths = [None] * len(ends)
+            else:
+                paths = _bfs_paths(csr.offsets, csr.targets, s, ids)
+            yield from _label_results(csr.labels, start, ends, paths)
+
+    @staticmethod
+    def _walk_back(edge_to, s, e):
+        """顺着 edge_to 从 e 倒着走回 s, 最后翻转一次"""
+        path = [e]
+        while e != s:
+            e = edge_to[e]
+            path.append(e)
+        path.reverse()
+        return path
+
+    def find_shortest_path_bidirectional(self, start, end):
+        """双向 BFS: 正向图从 start 出发, 反向图从 end 出发, 中间会师.
+
+        每轮挑当前前沿较小的一侧整层推进, 宽图上访问的节点数大约是单向 BFS
+        的平方根量级. 返回格式和 find_shortest_path_bfs 一样.
+        """
         if start == end:
-            return queue
+            return [start]
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return None
 
-        while len(queue):
-            value = queue.pop(0)
-            for node in self.graph[value]:
-                if node not in dist_to:  #dist_to s  dist_to.keys() 的简写
+        rcsr = self.rcsr
+        # 两侧各自的 (邻接表, 前沿, 到各点的距离/来路)
+        fwd = (csr.offsets, csr.targets, deque([s]), {s: 0}, {s: s})
+        bwd = (rcsr.offsets, rcsr.targets, deque([e]), {e: 0}, {e: e})
+
+        while fwd[2] and bwd[2]:
+            side, other = (fwd, bwd) if len(fwd[2]) <= len(bwd[2]) else (bwd, fwd)
+            offsets, targets, queue, dist_to, edge_to = side
+            other_dist = other[3]
+            best, meet = None, None
+            # 整层推进, 同一层里取最短的会师点, 保证结果最短
+            for _ in range(len(queue)):
+                value = queue.popleft()
+                for i in range(offsets[value], offsets[value + 1]):
+                    node = targets[i]
+                    if node in dist_to:
+                        continue
                     edge_to[node] = value
                     dist_to[node] = dist_to[value] + 1
+                    if node in other_dist:
+                        total = dist_to[node] + other_dist[node]
+                        if best is None or total < best:
+                            best, meet = total, node
                     queue.append(node)
-                    if end in edge_to:
-                        path = []
-                        node = end
-                        while dist_to[node] != 0:
-                            path.insert(0, node)
-                            node = edge_to[node]
-                        path.insert(0, start)
-                        return path
+            if meet is not None:
+                path = self._walk_back(fwd[4], s, meet)
+                node = meet
+                while node != e:
+                    node = bwd[4][node]
+                    path.append(node)
+                return self._to_labels(path)
+        return None
+
+    def _weight_array(self, weights):
+        """同一个 weights 对象只编译一次; weights 改动后需要重新 build()"""
+        if self._weights is None or self._weights[0] is not weights:
+            self._weights = (weights, self.csr.weights_from(weights))
+        return self._weights[1]
+
+    def find_shortest_path_dijkstra(self, start, end, weights):
+        """带权最短路. weights 是 {(u, v): w}, 没写的边权按 1 算"""
+        return self.find_shortest_path_astar(start, end, weights, heuristic=_zero)
+
+    def find_shortest_path_astar(self, start, end, weights, heuristic=None):
+        """A*. heuristic(node, end) 必须是不高估的下界(且满足三角不等式).
+
+        heuristic 不给的时候, 如果已经对同一份 weights 调过 build_landmarks(),
+        就用 ALT 下界; 否则退化成 Dijkstra.
+        """
+        if start == end:
+            return [start]
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return None
+
+        wts = self._weight_array(weights)
+        if heuristic is _zero:
+            h = None
+        elif heuristic is not None:
+            labels = csr.labels
+            h = lambda v: heuristic(labels[v], end)  # noqa: E731
+        elif self._landmarks is not None and self._landmarks[0] is weights:
+            h = self._alt_heuristic(e)
+        else:
+            h = None
+
+        edge_to = _dijkstra(csr.offsets, csr.targets, wts, s, e, h)[1]
+        if e not in edge_to:
+            return None
+        return self._to_labels(self._walk_back(edge_to, s, e))
+
+    def build_landmarks(self, weights, landmarks=4):
+        """ALT (A*, Landmarks, Triangle inequality) 预处理.
+
+        landmarks 可以是标签列表, 也可以是个数(按"离已选地标最远"挑选).
+        对每个地标 L 存下 d(L, v) 和 d(v, L), 由三角不等式
+        d(v, t) >= max(d(L, t) - d(L, v), d(v, L) - d(t, L)),
+        道路这类图上这个下界很紧.
+        """
+        csr, rcsr = self.csr, self.rcsr
+        wts = self._weight_array(weights)
+        rwts = csr.reverse_weights(wts)
+        n = len(csr)
+
+        def distances(offsets, targets, w, source):
+            dist = _dijkstra(offsets, targets, w, source)[0]
+            out = array('d', [_INF]) * n
+            for v, d in dist.items():
+                out[v] = d
+            return out
+
+        if isinstance(landmarks, int):
+            picked = []
+            closest = array('d', [_INF]) * n
+            candidate = 0
+            for _ in range(min(landmarks, n)):
+                picked.append(candidate)
+                dist = distances(csr.offsets, csr.targets, wts, candidate)
+                for v in range(n):
+                    if dist[v] < closest[v]:
+                        closest[v] = dist[v]
+                # 优先挑还没被覆盖到的点, 其次挑离已选地标最远的点
+                far = [v for v in range(n) if closest[v] == _INF]
+                if far:
+                    candidate = far[0]
+                else:
+                    candidate = max(range(n), key=closest.__getitem__)
+                    if closest[candidate] == 0:
+                        break
+        else:
+            picked = []
+            for label in landmarks:
+                v = csr.id_of(label)
+                if v is None:
+                    raise KeyError(f'landmark {label!r} is not in the graph')
+                picked.append(v)
+
+        table = []
+        for v in picked:
+            table.append((distances(csr.offsets, csr.targets, wts, v),
+                          distances(rcsr.offsets, rcsr.targets, rwts, v)))
+        self._landmarks = (weights, table)
+        return [csr.labels[v] for v in picked]
+
+    def _alt_heuristic(self, e):
+        table = [(d_from, d_to, d_from[e], d_to[e]) for d_from, d_to in self._landmarks[1]]
+
+        def h(v):
+            best = 0.0
+            for d_from, d_to, from_e, to_e in table:
+                # 不可达(inf)的项给不出下界, 跳过
+                if from_e != _INF and d_from[v] != _INF and from_e - d_from[v] > best:
+                    best = from_e - d_from[v]
+                if to_e != _INF and d_to[v] != _INF and d_to[v] - to_e > best:
+                    best = d_to[v] - to_e
+            return best
+
+        return h
+
+    def find_k_shortest_paths(self, start, end, k=None, weights=None):
+        """Yen 算法: 按长度从短到长逐条产出无环路径, 最多 k 条(None 不限).
+
+        weights 同 find_shortest_path_dijkstra, 不给就按跳数算. 每条新路径都
+        是从上一条的某个"偏离点"岔出去的; 按 Lawler 的改进, 只从它自己的
+        偏离点往后试岔路, 前面的岔路在父路径那一轮已经算过, 不重复算.
+        代价只和 k 有关, 和路径总数无关.
+        """
+        if k is not None and k <= 0:
+            return
+        if start == end:
+            yield [start]
+            return
+        csr = self.csr
+        s, e = csr.id_of(start), csr.id_of(end)
+        if s is None or e is None:
+            return
+
+        offsets, targets = csr.offsets, csr.targets
+        wts = None if weights is None else self._weight_array(weights)
+        first = _spur_path(offsets, targets, wts, s, e, (), ())
+        if first is None:
+            return
+
+        found = []  # [(path, 前缀代价, 偏离点)]
+        candidates = []
+        seen = {tuple(first[0])}
+        counter = 0
+        path, prefix, deviation = first[0], first[1], 0
+        while True:
+            found.append(path)
+            yield self._to_labels(path)
+            if k is not None and len(found) == k:
+                return
+
+            for i in range(deviation, len(path) - 1):
+                root = path[:i + 1]
+                banned_edges = {(p[i], p[i + 1]) for p in found
+                                if len(p) > i + 1 and p[:i + 1] == root}
+                spur = _spur_path(offsets, targets, wts, path[i], e, root[:-1], banned_edges)
+                if spur is None:
+                    continue
+                new_path = root[:-1] + spur[0]
+                key = tuple(new_path)
+                if key in seen:
+                    continue
+                seen.add(key)
+                new_prefix = prefix[:i] + [prefix[i] + c for c in spur[1]]
+                counter += 1
+                heappush(candidates, (new_prefix[-1], len(new_path), counter,
+                                      new_path, new_prefix, i))
+
+            if not candidates:
+                return
+            _, _, _, path, prefix, deviation = heappop(candidates)
+
+
+class ParallelGraphSearch:
+    """多进程批量查询.
+
+    CSR 的 offsets/targets 拷进一块 multiprocessing.shared_memory, 进程池里的
+    worker 启动时按名字挂载, 直接在共享内存上跑 BFS, 图本身既不复制也不 pickle.
+    进程间只传起点分组后的查询和结果(都是整数 id), 标签翻译留在主进程做.
+    用完要 close(), 或者放进 with 语句.
+    """
+
+    def __init__(self, graph_search, processes=None):
+        csr = self.csr = graph_search.csr
+        self.processes = processes or os.cpu_count() or 1
+        n_offsets, n_targets = len(csr.offsets), len(csr.targets)
+        nbytes = 4 * (n_offsets + n_targets)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        ints = self._shm.buf[:nbytes].cast('i')
+        ints[:n_offsets] = array('i', csr.offsets)
+        ints[n_offsets:] = array('i', csr.targets)
+        ints.release()
+        self._pool = ProcessPoolExecutor(
+            self.processes,
+            initializer=_attach_shared,
+            initargs=(self._shm.name, n_offsets, n_targets),
+        )
+
+    def find_shortest_paths_bfs(self, queries, chunksize=None):
+        """和 GraphSearch.find_shortest_paths_bfs 一样, 只是起点分组摊到各个进程"""
+        csr = self.csr
+        items = []
+        for start, ends in _group_by_source(queries).items():
+            items.append((start, ends, csr.id_of(start), [csr.id_of(end) for end in ends]))
+
+        jobs = [(s, ids) for _, _, s, ids in items if s is not None]
+        size = chunksize or max(1, len(jobs) // (self.processes * 4))
+        chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        answers = (paths for chunk in self._pool.map(_solve_groups, chunks) for paths in chunk)
+
+        for start, ends, s, _ in items:
+            paths = next(answers) if s is not None else [None] * len(ends)
+            yield from _label_results(csr.labels, start, ends, paths)
+
+    def close(self):
+        self._pool.shutdown()
+        self._shm.close()
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_INF = float('inf')
+
+
+def _zero(node, end):
+    return 0
+
+
+def _dijkstra(offsets, targets, weights, s, e=None, h=None):
+    """堆做前沿的 Dijkstra / A*, 过期的堆项取出来时再丢掉(lazy deletion).
+
+    给了 e 就在 e 出堆时提前结束; h(v) 是到 e 的下界估计.
+    返回 (dist_to, edge_to).
+    """
+    dist_to = {s: 0}
+    edge_to = {}
+    heap = [(h(s) if h else 0, s)]
+    done = set()
+    while heap:
+        _, value = heappop(heap)
+        if value in done:
+            continue
+        if value == e:
+            break
+        done.add(value)
+        d = dist_to[value]
+        for i in range(offsets[value], offsets[value + 1]):
+            node = targets[i]
+            nd = d + weights[i]
+            if node not in dist_to or nd < dist_to[node]:
+                dist_to[node] = nd
+                edge_to[node] = value
+                heappush(heap, (nd + h(node) if h else nd, node))
+    return dist_to, edge_to
+
+
+def _spur_path(offsets, targets, weights, s, e, banned_nodes, banned_edges):
+    """Yen 的岔路: 避开 banned_nodes 和 banned_edges 的 s -> e 最短路.
+
+    weights 为 None 时按跳数算. 返回 (path, 沿途累计代价) 或 None.
+    """
+    banned_nodes = set(banned_nodes)
+    dist_to = {s: 0}
+    edge_to = {}
+    heap = [(0, s)]
+    done = set()
+    while heap:
+        d, value = heappop(heap)
+        if value in done:
+            continue
+        if value == e:
+            break
+        done.add(value)
+        for i in range(offsets[value], offsets[value + 1]):
+            node = targets[i]
+            if node in banned_nodes or (value, node) in banned_edges:
+                continue
+            nd = d + (1 if weights is None else weights[i])
+            if node not in dist_to or nd < dist_to[node]:
+                dist_to[node] = nd
+                edge_to[node] = value
+                heappush(heap, (nd, node))
+    else:
+        return None
+    path = GraphSearch._walk_back(edge_to, s, e)
+    return path, [dist_to[v] for v in path]
+
+
+def _group_by_source(queries):
+    groups = {}
+    for start, end in queries:
+        groups.setdefault(start, []).append(end)
+    return groups
+
+
+def _bfs_paths(offsets, targets, s, ends):
+    """从 s 跑一次 BFS, 回答 ends 里每个终点(整数 id, 可以是 None)的最短路"""
+    wanted = set(ends)
+    wanted.discard(None)
+    wanted.discard(s)
+    queue = deque([s])
+    edge_to = {s: s}
+    while queue and wanted:
+        value = queue.popleft()
+        for i in range(offsets[value], offsets[value + 1]):
+            node = targets[i]
+            if node not in edge_to:
+                edge_to[node] = value
+                wanted.discard(node)
+                queue.append(node)
+    return [GraphSearch._walk_back(edge_to, s, e) if e in edge_to else None for e in ends]
+
+
+def _label_results(labels, start, ends, paths):
+    for end, path in zip(ends, paths):
+        if start == end:
+            yield start, end, [start]
+        elif path is None:
+            yield start, end, None
+        else:
+            yield start, end, [labels[v] for v in path]
+
+
+# worker 进程里挂载的共享内存: (shm, offsets, targets)
+_shared = None
+
+
+def _attach_shared(name, n_offsets, n_targets):
+    global _shared
+    shm = shared_memory.SharedMemory(name=name)
+    ints = shm.buf[:4 * (n_offsets + n_targets)].cast('i')
+    _shared = (shm, ints[:n_offsets], ints[n_offsets:])
+
+
+def _solve_groups(groups):
+    _, offsets, targets = _shared
+    return [_bfs_paths(offsets, targets, s, ends) for s, ends in groups]
+
+
+def _tarjan_scc(offsets, targets):
+    """非递归 Tarjan 强连通分量, O(V + E).
+
+    返回 (comp, count), comp[v] 是 v 所在分量的编号. 分量按逆拓扑序编号:
+    若分量 c 有边连到分量 d, 则 d < c.
+    """
+    n = len(offsets) - 1
+    index = array('i', [-1]) * n
+    low = array('i', [0]) * n
+    comp = array('i', [-1]) * n
+    stack = []
+    counter = count = 0
+    for root in range(n):
+        if index[root] != -1:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        work = [[root, offsets[root]]]  # [节点, 下一条待走的出边]
+        while work:
+            frame = work[-1]
+            v, i = frame
+            if i < offsets[v + 1]:
+                frame[1] = i + 1
+                w = targets[i]
+                if index[w] == -1:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    work.append([w, offsets[w]])
+                elif comp[w] == -1 and index[w] < low[v]:  # w 还在栈上
+                    low[v] = index[w]
+                continue
+            work.pop()
+            if work and low[v] < low[work[-1][0]]:
+                low[work[-1][0]] = low[v]
+            if low[v] == index[v]:
+                while True:
+                    w = stack.pop()
+                    comp[w] = count
+                    if w == v:
+                        break
+                count += 1
+    return comp, count
+
+
+def random_graph(n, degree, seed=0):
+    """n 个节点, 每个节点 degree 条随机出边, 跑 benchmark 用"""
+    rng = random.Random(seed)
+    return {v: [rng.randrange(n) for _ in range(degree)] for v in range(n)}
+
+
+def bench_batch(n=10000, degree=4, sources=20, queries=1000):
+    """批量查询 vs 循环调用 find_shortest_path_bfs"""
+    rng = random.Random(1)
+    graph_search = GraphSearch(random_graph(n, degree))
+    graph_search.build()
+    pairs = [(rng.randrange(sources), rng.randrange(n)) for _ in range(queries)]
+
+    t0 = time.perf_counter()
+    for start, end in pairs:
+        graph_search.find_shortest_path_bfs(start, end)
+    loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    for _ in graph_search.find_shortest_paths_bfs(pairs):
+        pass
+    batch = time.perf_counter() - t0
+    print(f'{queries} queries / {sources} sources: '
+          f'loop {loop:.3f}s, batch {batch:.3f}s, x{loop / batch:.1f}')
+
+
+def bench_parallel(n=100000, degree=4, sources=128, queries=10000):
+    """单进程批量查询 vs ParallelGraphSearch, 进程数从 1 翻倍到 cpu_count"""
+    rng = random.Random(2)
+    graph_search = GraphSearch(random_graph(n, degree))
+    graph_search.build()
+    pairs = [(rng.randrange(sources), rng.randrange(n)) for _ in range(queries)]
+
+    t0 = time.perf_counter()
+    for _ in graph_search.find_shortest_paths_bfs(pairs):
+        pass
+    serial = time.perf_counter() - t0
+    print(f'serial: {serial:.3f}s')
+
+    processes = 1
+    while processes <= (os.cpu_count() or 1):
+        with ParallelGraphSearch(graph_search, processes) as executor:
+            t0 = time.perf_counter()
+            for _ in executor.find_shortest_paths_bfs(pairs):
+                pass
+            took = time.perf_counter() - t0
+        print(f'{processes:>2} processes: {took:.3f}s, x{serial / took:.1f}')
+        processes *= 2
+
+
+def bench_scc(n=10 ** 6, degree=2):
+    """10^6 个节点上的 SCC 和缩点"""
+    graph_search = GraphSearch(random_graph(n, degree))
+    t0 = time.perf_counter()
+    graph_search.build()
+    built = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    components = graph_search.strongly_connected_components()
+    scc = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    _, dag = graph_search.condensation()
+    condensed = time.perf_counter() - t0
+    print(f'{n} nodes, {n * degree} edges: build {built:.2f}s, '
+          f'scc {scc:.2f}s ({len(components)} components, largest '
+          f'{max(map(len, components))}), condensation {condensed:.2f}s '
+          f'({len(dag.targets)} dag edges)')
 
 
 def main():
@@ -122,9 +1433,13 @@ def main():
     >>> graph_search.find_path_dfs('c','x')
 
 
-    # ALL PATH DFS
-    >>> graph_search.find_all_paths_dfs('a','d')
+    # ALL PATH DFS, 生成器, 要多少取多少
+    >>> list(graph_search.find_all_paths_dfs('a','d'))
     [['a', 'b', 'c', 'd'], ['a', 'b', 'd'], ['a', 'c', 'd']]
+    >>> next(graph_search.find_all_paths_dfs('a','d'))
+    ['a', 'b', 'c', 'd']
+    >>> list(graph_search.find_all_paths_dfs('c','x'))
+    []
 
     # SHORTEST DFS
     >>> graph_search.find_shortest_path_dfs('a','d')
@@ -143,10 +1458,153 @@ def main():
 
     >>> graph_search.find_shortest_path_bfs('a','x')
 
+    # 批量查询, 同一起点只跑一次 BFS
+    >>> for start, end, path in graph_search.find_shortest_paths_bfs(
+    ...         [('a', 'd'), ('g', 'f'), ('a', 'f'), ('a', 'h')]):
+    ...     print(start, end, path)
+    a d ['a', 'b', 'd']
+    a f ['a', 'c', 'g', 'e', 'f']
+    a h None
+    g f ['g', 'e', 'f']
+
+    # 多进程, 图放在共享内存里
+    >>> with ParallelGraphSearch(graph_search, processes=2) as executor:
+    ...     sorted(executor.find_shortest_paths_bfs([('a', 'f'), ('g', 'f'), ('x', 'x')]))
+    [('a', 'f', ['a', 'c', 'g', 'e', 'f']), ('g', 'f', ['g', 'e', 'f']), ('x', 'x', ['x'])]
+
+    # 双向 BFS, 两头往中间搜
+    >>> graph_search.find_shortest_path_bidirectional('a','f')
+    ['a', 'c', 'g', 'e', 'f']
+    >>> graph_search.find_shortest_path_bidirectional('g','f')
+    ['g', 'e', 'f']
+    >>> graph_search.find_shortest_path_bidirectional('a','h')
+
+    >>> [graph_search.csr.labels[v] for v in graph_search.rcsr.neighbours(graph_search.csr.id_of('c'))]
+    ['a', 'b', 'd', 'f', 'h']
+
+    # 带权: Dijkstra / A* / ALT
+    >>> weights = {('a', 'b'): 1, ('a', 'c'): 5, ('b', 'c'): 1, ('b', 'd'): 4,
+    ...            ('c', 'd'): 1, ('c', 'g'): 1, ('g', 'e'): 1, ('e', 'f'): 1}
+    >>> graph_search.find_shortest_path_dijkstra('a', 'd', weights)
+    ['a', 'b', 'c', 'd']
+    >>> graph_search.find_shortest_path_astar('a', 'f', weights, lambda node, end: 0)
+    ['a', 'b', 'c', 'g', 'e', 'f']
+    >>> graph_search.build_landmarks(weights, 2)
+    ['a', 'h']
+    >>> graph_search.build_landmarks(weights, ['a', 'z'])
+    Traceback (most recent call last):
+    ...
+    KeyError: "landmark 'z' is not in the graph"
+    >>> graph_search.find_shortest_path_astar('a', 'f', weights)
+    ['a', 'b', 'c', 'g', 'e', 'f']
+    >>> graph_search.find_shortest_path_astar('a', 'h', weights)
+
+    # 可达性索引, 边的增删增量维护
+    >>> graph_search.is_reachable('a', 'f'), graph_search.is_reachable('f', 'a')
+    (True, False)
+    >>> graph_search.add_edge('f', 'a')
+    >>> graph_search.is_reachable('f', 'a'), graph_search.find_path_dfs('f', 'a')
+    (True, ['f', 'a'])
+    >>> graph_search.remove_edge('f', 'a')
+    >>> graph_search.is_reachable('f', 'a'), graph_search.find_path_dfs('f', 'a')
+    (False, None)
+
+    # 直接改了 graph 的话, build() 之后索引也重建
+    >>> graph_search.graph['h'].append('a')
+    >>> _ = graph_search.build()
+    >>> graph_search.is_reachable('h', 'a')
+    True
+    >>> graph_search.graph['h'].remove('a')
+    >>> _ = graph_search.build()
+
+    # 分量太多时不建 C^2 的位图, 在缩点 DAG 上按拓扑序剪枝搜索
+    >>> sparse = ReachabilityIndex(graph_search.graph, max_components=2)
+    >>> sparse.reach is None, sparse.is_reachable('a', 'f'), sparse.is_reachable('f', 'a')
+    (True, True, False)
+
+    # 存盘再用 mmap 打开, 直接在文件上搜
+    >>> import os, tempfile
+    >>> tmp = tempfile.mkdtemp()
+    >>> graph_search.csr.save(os.path.join(tmp, 'graph.gscsr'))
+    >>> on_disk = GraphSearch.open(os.path.join(tmp, 'graph.gscsr'))
+    >>> on_disk.find_shortest_path_bfs('a', 'f'), on_disk.find_path_dfs('c', 'h')
+    (['a', 'c', 'g', 'e', 'f'], None)
+    >>> on_disk.is_reachable('a', 'f'), on_disk.is_reachable('f', 'a')
+    (True, False)
+
+    # 文件里只存 str 标签
+    >>> GraphSearch({1: [2], 2: []}).csr.save(os.path.join(tmp, 'ints.gscsr'))
+    Traceback (most recent call last):
+    ...
+    TypeError: GSCSR files only store str labels, got 1
+    >>> on_disk.csr.id_of(1)
+    Traceback (most recent call last):
+    ...
+    TypeError: GSCSR graphs have str labels, got 1
+
+    # 用完关掉 mmap, 也可以用 with
+    >>> on_disk.csr.close()
+    >>> on_disk.find_shortest_path_bfs('a', 'f')
+    Traceback (most recent call last):
+    ...
+    ValueError: operation forbidden on released memoryview object
+    >>> with CompactGraph.open(os.path.join(tmp, 'graph.gscsr')) as csr:
+    ...     csr.labels[csr.id_of('f')]
+    'f'
+
+    # 文本边表流式转换
+    >>> with open(os.path.join(tmp, 'edges.txt'), 'w') as f:
+    ...     _ = f.write('# u v\\nx y\\ny z\\nx z\\nlonely\\n')
+    >>> convert_edge_list(os.path.join(tmp, 'edges.txt'), os.path.join(tmp, 'edges.gscsr'))
+    (4, 3)
+    >>> edges = GraphSearch.open(os.path.join(tmp, 'edges.gscsr'))
+    >>> list(edges.find_all_paths_dfs('x', 'z')), edges.csr.id_of('lonely')
+    ([['x', 'y', 'z'], ['x', 'z']], 3)
+    >>> edges.csr.close()
+
+    # 强连通分量, 按缩点后的拓扑序排列
+    >>> graph_search.strongly_connected_components()
+    [['h'], ['a'], ['b'], ['c', 'd', 'e', 'f', 'g']]
+    >>> comp, dag = graph_search.condensation()
+    >>> comp['a'], comp['e'], [dag.neighbours(c).tolist() for c in range(len(dag))]
+    (1, 3, [[3], [2, 3], [3], []])
+
+    # 结果缓存, 改图后自动失效
+    >>> cached = GraphSearch({k: list(v) for k, v in graph.items()}, cache_size=2)
+    >>> cached.find_shortest_path_bfs('a', 'f'), cached.find_shortest_path_bfs('a', 'f')
+    (['a', 'c', 'g', 'e', 'f'], ['a', 'c', 'g', 'e', 'f'])
+    >>> cached.find_path_dfs('a', 'd'), cached.find_path_dfs('g', 'f')
+    (['a', 'b', 'c', 'd'], ['g', 'e', 'f'])
+    >>> cached.add_edge('a', 'f')
+    >>> cached.find_shortest_path_bfs('a', 'f')
+    ['a', 'f']
+    >>> cached.cache_info()
+    {'hits': 1, 'misses': 4, 'evictions': 1, 'invalidations': 1, 'size': 1, 'maxsize': 2}
+
+    # k 条最短无环路径, 从短到长
+    >>> list(graph_search.find_k_shortest_paths('a', 'd', k=2))
+    [['a', 'b', 'd'], ['a', 'c', 'd']]
+    >>> list(graph_search.find_k_shortest_paths('a', 'd', weights=weights))
+    [['a', 'b', 'c', 'd'], ['a', 'b', 'd'], ['a', 'c', 'd']]
+
+    # CSR: 标签驻留成整数, 邻接表拍平成两个 array
+    >>> csr = graph_search.csr
+    >>> csr.labels
+    ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h']
+    >>> csr.offsets
+    array('i', [0, 2, 4, 6, 7, 8, 9, 10, 11])
+    >>> csr.targets
+    array('i', [1, 2, 2, 3, 3, 6, 2, 5, 2, 4, 2])
+    >>> [csr.labels[v] for v in csr.neighbours(csr.id_of('c'))]
+    ['d', 'g']
     """
 
 
 if __name__ == "__main__":
-    # main()
-    import doctest
-    doctest.testmod(verbose=True)
+    if '--bench' in sys.argv:
+        bench_batch()
+        bench_parallel()
+        bench_scc()
+    else:
+        import doctest
+        doctest.testmod(verbose=True)
@@ -18,37 +18,1015 @@ sample_queue.get() 会重复使用刚才那个对象.
 *参考:
 https://github.com/faif/python_patterns
 
+*真要拿来用?
+ObjectPool 只是给现成的队列套了个 with. 数据库/HTTP 连接这种资源还得管:
+池子最多多大, 不够了现造(factory), 等多久算超时, 取出来前先验一验还能不能用,
+闲太久或者活太久的要淘汰. ResourcePool 把这些都管起来, 并且长得像一个
+queue.Queue(get/put), 所以 ObjectPool 可以直接套在它上面, with 结束必定归还.
+
+*池子里到底发生了什么?
+给 ResourcePool 一个 PoolMetrics, 就能看到借出要等多久, 东西被拿走多久, 造了/
+淘汰了多少, 以及哪里借了东西没还(ObjectPool 被 GC 时东西还在手上, 就报告当初
+借出时的调用栈). snapshot() 导出成 dict.
+
+*按 key 分池
+每个后端主机一个池子, 各管各的上限, 但总连接数还得有个总闸. KeyedResourcePool
+满了就淘汰全局最久没用的空闲连接; 等待者全局排队, 热门 key 抢不走冷门 key 的名额.
+
+*大块字节在进程间传
+pickle 一来一回要拷两次. SharedBufferPool 在共享内存里预先切好等长的 slab,
+借出来直接是 memoryview, 发给别的进程的只是 slab 编号, 对方挂上同一块内存就能读写.
+
+*线程多了抢锁怎么办?
+queue.Queue 只有一把锁, 几十个线程一起借还就都堵在这上面. ThreadCachedPool
+给每个线程留一个小缓存, 自己还的自己先用, 不用碰锁; 缓存满了再溢出到共享队列,
+共享队列空了就去别的线程缓存里偷.
+
+*asyncio 里怎么办?
+queue.Queue.get() 会把整个事件循环堵住. AsyncObjectPool 是协程版: async with
+借还, 等待的协程严格先来先得(归还时直接把对象交到排头那位手里, 不让后来的插队),
+等待中被 cancel 的协程也不会把对象吞掉.
+
 *概述 TL;DR
 保存一组初始化好的实例对象, 以供开箱即用.
 """
 
+import asyncio
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import warnings
+import weakref
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from multiprocessing import shared_memory
+from traceback import format_stack
+
 
 class ObjectPool:
     """带 with 功能的队列管理"""
 
     def __init__(self, queue, auto_get=True) -> None:
         self._queue = queue
-        self.item = self._queue.get() if auto_get else None
+        # [item, 借出时的调用栈]; finalize 的回调不能引用 self, 所以放在一个格子里
+        self._slot = [None, None]
+        self._finalizer = None
+        if auto_get:
+            self._get()
+
+    @property
+    def item(self):
+        return self._slot[0]
+
+    @item.setter
+    def item(self, value):
+        self._slot[0] = value
 
     def __enter__(self):
         """如果 item 为空, 从队列取出一个"""
-        if self.item is None:
-            self.item = self._queue.get()
-        return self.item
+        if self._slot[0] is None:
+            self._get()
+        return self._slot[0]
 
     def __exit__(self, exc_type, exc_value, traceback):
         """如果 item 不空, 把 item 存入队列后, 设为 None"""
-        if self.item is not None:
-            self._queue.put(self.item)
-            self.item = None
+        item = self._slot[0]
+        if item is not None:
+            self._queue.put(item)
+            self._slot[0] = None
 
     def __del__(self):
-        """GC 的时候存一下"""
+        """GC 的时候存一下. 开了泄漏检测的挂了 finalize, 交给它去报告和归还"""
+        if self._finalizer is None and self._slot[0] is not None:
+            _return_on_gc(self._queue, self._slot)
+
+    def _get(self):
+        self._slot[0] = self._queue.get()
+        metrics = getattr(self._queue, 'metrics', None)
+        if metrics is not None and metrics.track_leaks:
+            self._slot[1] = ''.join(format_stack()[:-2])
+            # 泄漏检测时改由 finalize 负责: GC 时它来报告和归还, 解释器退出时还没被
+            # 回收的也能报出来. 不开检测就只靠上面的 __del__, 每次借还不多花注册 finalize 的钱
+            if self._finalizer is None:
+                self._finalizer = weakref.finalize(self, _return_on_gc, self._queue, self._slot)
+
+
+def _return_on_gc(queue, slot):
+    """GC 时把没还的还回去, 还完清空格子. 不开泄漏检测时由 __del__ 调,
+    开了的话由 finalize 调, 顺便报告是在哪借出去的"""
+    item, stack = slot
+    if item is None:
+        return
+    slot[0] = None
+    metrics = getattr(queue, 'metrics', None)
+    if metrics is not None and metrics.track_leaks:
+        metrics.leaked(item, stack)
+        warnings.warn(f'{item!r} was never returned, checked out at:\n{stack}',
+                      ResourceWarning, stacklevel=2)
+    queue.put(item)
+
+
+class PoolMetrics:
+    """池子的运行指标, 交给 ResourcePool(metrics=...) 才会记录; 不给就一点开销都没有
+
+    - 借出等待时间直方图, 借出持有时间的 p50/p99(最近 window 次)
+    - created / evicted / invalid / timeouts 计数; evicted 只算闲置/超龄淘汰,
+      验不过的只记 invalid, 关池子销毁的不记
+    - track_leaks=True 时记录借出调用栈, 没还就被 GC 的 ObjectPool 会报告出来
+    """
+
+    WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, track_leaks=False, window=1024):
+        self.track_leaks = track_leaks
+        self.counters = {'created': 0, 'evicted': 0, 'invalid': 0, 'timeouts': 0}
+        self.wait_histogram = [0] * (len(self.WAIT_BUCKETS) + 1)
+        self.hold_times = deque(maxlen=window)
+        self.leaks = []
+        self._out = {}  # id(item) -> 借出时间
+        self._lock = threading.Lock()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def checked_out(self, item, waited):
+        with self._lock:
+            self.wait_histogram[bisect_left(self.WAIT_BUCKETS, waited)] += 1
+            self._out[id(item)] = time.monotonic()
+
+    def returned(self, item):
+        with self._lock:
+            since = self._out.pop(id(item), None)
+            if since is not None:
+                self.hold_times.append(time.monotonic() - since)
+
+    def leaked(self, item, stack):
+        with self._lock:
+            self.leaks.append({'item': repr(item), 'stack': stack})
+
+    def snapshot(self, pool=None):
+        """导出成一个普通 dict, 给日志/监控用"""
+        with self._lock:
+            holds = sorted(self.hold_times)
+            snap = dict(self.counters)
+            labels = [f'<={bound}' for bound in self.WAIT_BUCKETS] + [f'>{self.WAIT_BUCKETS[-1]}']
+            snap['wait_histogram'] = dict(zip(labels, self.wait_histogram))
+            snap['hold_p50'] = _percentile(holds, 0.50)
+            snap['hold_p99'] = _percentile(holds, 0.99)
+            snap['leaks'] = list(self.leaks)
+        if pool is not None:
+            snap['idle'] = pool.idle
+            snap['in_use'] = pool.size - pool.idle
+        return snap
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class ResourcePool:
+    """有界, 线程安全的资源池
+
+    - factory() 造新资源, 池里没有空闲且总数没到 max_size 时才造
+    - validate(item) 取出前检查, 返回 False 的就地销毁, 换一个
+    - destroy(item) 销毁资源(关连接之类)
+    - max_idle 闲置超过这么多秒的淘汰(但至少留 min_size 个), max_lifetime
+      从创建起活过这么多秒的淘汰
+    - 超龄/验不过被销毁后总数掉到 min_size 以下, 当场补造到 min_size
+    - get/put 和 queue.Queue 一样, 超时抛 queue.Empty
+    factory/validate/destroy 都在锁外调用, 慢也不会堵住别的线程.
+    """
+
+    def __init__(self, factory, min_size=0, max_size=10, timeout=None,
+                 validate=None, destroy=None, max_idle=None, max_lifetime=None,
+                 metrics=None):
+        if not 0 <= min_size <= max_size:
+            raise ValueError('need 0 <= min_size <= max_size')
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.validate = validate
+        self.destroy = destroy
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.metrics = metrics
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (item, 创建时间, 归还时间), 右端是最近还的
+        self._in_use = {}  # id(item) -> 创建时间, 资源不一定可 hash
+        self._size = 0  # 空闲 + 借出 + 正在创建
+        self._closed = False
+        for _ in range(min_size):
+            self._size += 1
+            self._idle.append((self._create(), time.monotonic(), time.monotonic()))
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def get(self, block=True, timeout=None):
+        """借一个出来. 拿不到时最多等 timeout 秒(默认用池子的 timeout)"""
+        if timeout is None:
+            timeout = self.timeout
+        if not block:
+            timeout = 0
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        metrics = self.metrics
+        if metrics is None:
+            return self._get(deadline)
+        try:
+            item = self._get(deadline)
+        except queue.Empty:
+            metrics.count('timeouts')
+            raise
+        metrics.checked_out(item, time.monotonic() - started)
+        return item
+
+    def _get(self, deadline):
+        while True:
+            item = self._reserve(deadline)
+            if item is _CREATE:
+                return self._checkout(self._create(), time.monotonic())
+            if self.validate is None or self._try_validate(item):
+                return item
+            self._discard(item, 'invalid')
+
+    def put(self, item, block=True, timeout=None):
+        """还回来. 池子关了或者资源活得太久, 就直接销毁"""
+        now = time.monotonic()
+        with self._cond:
+            created = self._in_use.pop(id(item), None)
+            if created is None:
+                raise ValueError(f'{item!r} was not checked out from this pool')
+            keep = not self._closed and (
+                self.max_lifetime is None or now - created < self.max_lifetime)
+            if keep:
+                self._idle.append((item, created, now))
+                self._cond.notify()
+        if self.metrics is not None:
+            self.metrics.returned(item)
+        if not keep:
+            self._discard(item, None if self._closed else 'evicted')
+
+    def checkout(self):
+        """with pool.checkout() as item: ... 出了 with 一定还回池里"""
+        return ObjectPool(self, auto_get=False)
+
+    def stats(self):
+        """metrics 的快照加上当前空闲/借出数; 没开 metrics 返回 None"""
+        return None if self.metrics is None else self.metrics.snapshot(self)
+
+    def evict(self):
+        """淘汰闲置/超龄的空闲资源; 借出时也会顺手做一次"""
+        with self._cond:
+            expired = self._expired(time.monotonic())
+        for item in expired:
+            self._discard(item, 'evicted')
+        return len(expired)
+
+    def close(self):
+        """销毁所有空闲资源, 借出去的在归还时销毁"""
+        with self._cond:
+            self._closed = True
+            idle = [item for item, _, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for item in idle:
+            self._discard(item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _reserve(self, deadline):
+        """在锁里决定: 拿一个空闲的, 还是占个名额去造新的, 还是等"""
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError('pool is closed')
+                expired = self._expired(time.monotonic())
+                if not expired:
+                    if self._idle:
+                        item, created, _ = self._idle.pop()
+                        self._in_use[id(item)] = created
+                        return item
+                    if self._size < self.max_size:
+                        self._size += 1
+                        return _CREATE
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty
+                    self._cond.wait(remaining)
+                    continue
+            # 淘汰下来的在锁外销毁, 然后重新来过
+            for item in expired:
+                self._discard(item, 'evicted')
+
+    def _expired(self, now):
+        """从空闲队列里摘掉该淘汰的(调用方持锁), 返回它们.
+
+        每次借出都要调, 所以只看两头: 左端是还回来最久的, 闲置超时只可能从这头开始;
+        右端是下一个要借出去的, 超龄的不能借出去. 夹在中间的超龄资源等挪到两头再摘.
+        """
+        expired = []
+        max_idle, max_lifetime = self.max_idle, self.max_lifetime
+        if max_idle is None and max_lifetime is None:
+            return expired
+        idle = self._idle
+        while idle:
+            item, created, returned = idle[0]
+            too_old = max_lifetime is not None and now - created >= max_lifetime
+            too_idle = (max_idle is not None and now - returned >= max_idle
+                        and self._size - len(expired) > self.min_size)
+            if not (too_old or too_idle):
+                break
+            idle.popleft()
+            expired.append(item)
+        if max_lifetime is not None:
+            while idle and now - idle[-1][1] >= max_lifetime:
+                expired.append(idle.pop()[0])
+        return expired
+
+    def _create(self):
+        try:
+            item = self.factory()
+        except BaseException:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        if self.metrics is not None:
+            self.metrics.count('created')
+        return item
+
+    def _checkout(self, item, created):
+        with self._cond:
+            self._in_use[id(item)] = created
+        return item
+
+    def _try_validate(self, item):
+        try:
+            return self.validate(item)
+        except Exception:
+            return False
+
+    def _discard(self, item, reason=None):
+        """销毁一个资源并让出名额. 资源已经不在 _idle/_in_use 里了.
+        reason 是要记的计数('evicted' 闲置/超龄淘汰, 'invalid' 验不过), 关池子不记"""
+        with self._cond:
+            self._in_use.pop(id(item), None)
+            self._size -= 1
+            self._cond.notify()
+        if reason is not None and self.metrics is not None:
+            self.metrics.count(reason)
+        if self.destroy is not None:
+            self.destroy(item)
+        if self._size < self.min_size:
+            self._top_up()
+
+    def _top_up(self):
+        """补造到 min_size 个. 在锁外造; factory 出错就先不补了, 下次销毁时再试"""
+        while True:
+            with self._cond:
+                if self._closed or self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                item = self._create()
+            except Exception:
+                return
+            now = time.monotonic()
+            with self._cond:
+                closed = self._closed
+                if not closed:
+                    self._idle.append((item, now, now))
+                    self._cond.notify()
+            if closed:
+                self._discard(item)
+                return
+
+
+_CREATE = object()
+
+
+class AsyncObjectPool:
+    """asyncio 版对象池, 语义同 ObjectPool: 借出去, 用完还回来
+
+    - items: 一开始就放进池里的对象
+    - factory: async 函数, 池里没有空闲且总数没到 max_size 时现造
+    - teardown: async 函数, 池子关闭后销毁对象
+    等待者按 FIFO 排队, put() 把对象直接交给排头的等待者.
+    """
+
+    def __init__(self, items=(), factory=None, teardown=None, max_size=None):
+        self.factory = factory
+        self.teardown = teardown
+        self.max_size = max_size
+        self._idle = deque(items)
+        self._size = len(self._idle)
+        self._waiters = deque()
+        self._closed = False
+        self._teardowns = set()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    async def get(self):
+        while True:
+            if self._closed:
+                raise RuntimeError('pool is closed')
+            # 有人在排队时, 哪怕刚好有空闲也不插队
+            if self._idle and not self._waiters:
+                return self._idle.popleft()
+            if self.factory is not None and (self.max_size is None or self._size < self.max_size):
+                self._size += 1
+                try:
+                    return await self.factory()
+                except BaseException:  # 包括 CancelledError, 名额要让出来
+                    self._size -= 1
+                    self._hand_over(_RETRY)
+                    raise
+
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                item = await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 东西已经交到手上才被 cancel: 转交下一位, 不能吞掉
+                    self._hand_over(waiter.result())
+                else:
+                    self._waiters.remove(waiter)
+                raise
+            if item is not _RETRY:
+                return item
+            # 有人造失败让出了名额, 重新走一遍, 自己去造
+
+    def put(self, item):
+        """同步方法, finally 里也能直接调"""
+        if self._closed:
+            self._size -= 1
+            if self.teardown is not None:
+                task = asyncio.get_running_loop().create_task(self.teardown(item))
+                self._teardowns.add(task)
+                task.add_done_callback(self._teardowns.discard)
+            return
+        self._hand_over(item)
+
+    def checkout(self):
+        """async with pool.checkout() as item: ... 出了 with 一定还回池里"""
+        return _AsyncCheckout(self)
+
+    async def aclose(self):
+        """关闭池子: 排队的协程收到 RuntimeError, 空闲对象逐个 teardown,
+        还在外面的对象归还时再 teardown"""
+        self._closed = True
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(RuntimeError('pool is closed'))
+        while self._idle:
+            self.put(self._idle.popleft())
+        if self._teardowns:
+            await asyncio.gather(*self._teardowns)
+
+    def _hand_over(self, item):
+        """交给排头还在等的协程; 没人等就放回空闲队列(_RETRY 没人要就算了)"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(item)
+                return
+        if item is not _RETRY:
+            self._idle.append(item)
+
+
+_RETRY = object()
+
+
+class _AsyncCheckout:
+    """ObjectPool 的 async with 版本"""
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.item = None
+
+    async def __aenter__(self):
+        if self.item is None:
+            self.item = await self._pool.get()
+        return self.item
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
         if self.item is not None:
-            self._queue.put(self.item)
+            self._pool.put(self.item)
             self.item = None
 
 
+class ThreadCachedPool:
+    """每个线程一个小缓存挡在共享队列前面, 减少抢同一把锁
+
+    - get: 先从本线程缓存取(无锁), 没有再去共享队列, 还没有就去别的
+      线程缓存里"偷"一个(steal-back), 再等共享队列
+    - put: 本线程缓存没满就放本地, 满了溢出到共享队列
+    缓存是 deque, 主人从右端进出, 小偷从左端拿, 单个操作都是原子的.
+    和 queue.Queue 一样有 get/put, 所以同样可以套 ObjectPool.
+    """
+
+    def __init__(self, shared, cache_size=4, steal_interval=0.01):
+        self.shared = shared
+        self.cache_size = cache_size
+        self.steal_interval = steal_interval
+        self._local = threading.local()
+        self._caches = []  # [(线程, 缓存)], 偷的时候遍历
+        self._caches_lock = threading.Lock()
+
+    def _cache(self):
+        try:
+            return self._local.cache
+        except AttributeError:
+            cache = self._local.cache = deque()
+            with self._caches_lock:
+                self._caches.append((threading.current_thread(), cache))
+            return cache
+
+    def get(self, block=True, timeout=None):
+        cache = self._cache()
+        try:
+            return cache.pop()
+        except IndexError:
+            pass
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                return self.shared.get_nowait()
+            except queue.Empty:
+                pass
+            item = self._steal(cache)
+            if item is not _EMPTY:
+                return item
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not block or (remaining is not None and remaining <= 0):
+                raise queue.Empty
+            # 东西可能躺在别的线程缓存里, 所以不能一直死等共享队列
+            wait = self.steal_interval if remaining is None else min(remaining, self.steal_interval)
+            try:
+                return self.shared.get(timeout=wait)
+            except queue.Empty:
+                pass
+
+    def put(self, item, block=True, timeout=None):
+        cache = self._cache()
+        if len(cache) < self.cache_size:
+            cache.append(item)
+        else:
+            self.shared.put(item, block, timeout)
+
+    def drain(self):
+        """把本线程缓存里的东西都还给共享队列, 线程退出前调一下最好"""
+        cache = self._cache()
+        while cache:
+            self.shared.put(cache.popleft())
+
+    def _steal(self, own):
+        with self._caches_lock:
+            caches = list(self._caches)
+        dead = set()
+        for thread, cache in caches:
+            if cache is own:
+                continue
+            try:
+                return cache.popleft()
+            except IndexError:
+                if not thread.is_alive():
+                    dead.add(id(cache))
+        if dead:
+            with self._caches_lock:
+                self._caches = [entry for entry in self._caches
+                                if id(entry[1]) not in dead or entry[1]]
+        return _EMPTY
+
+
+_EMPTY = object()
+
+
+class KeyedResourcePool:
+    """按 key 分的子池(比如每个后端主机一个连接池), 外加一个全局上限
+
+    - factory(key) 造资源, destroy(key, item) 销毁
+    - 每个 key 最少 min_per_key 个(第一次用到时预热), 最多 max_per_key 个,
+      limits={key: (min, max)} 可以单独指定
+    - 所有 key 加起来最多 max_total 个; 满了而某个 key 还没到上限时,
+      淘汰全局最久没用的空闲资源(LRU, 哪个 key 的都行)给它腾位置
+    - 公平: 等待者全局先来先得. 排在前面的 key 在等全局名额时, 别的 key
+      还回来的空闲资源会被淘汰掉让给它, 热门 key 饿不死冷门 key
+    - validate(key, item) 借出空闲资源前检查, 返回 False 的销毁掉再排一次;
+      release 只收从本池借出, 还没还过的资源
+    """
+
+    def __init__(self, factory, max_total, max_per_key=None, min_per_key=0,
+                 limits=None, timeout=None, destroy=None, validate=None):
+        self.factory = factory
+        self.destroy = destroy
+        self.validate = validate
+        self.max_total = max_total
+        self.max_per_key = max_total if max_per_key is None else max_per_key
+        self.min_per_key = min_per_key
+        self.limits = limits or {}
+        self.timeout = timeout
+
+        self._cond = threading.Condition()
+        self._idle = {}  # key -> deque[item]
+        self._lru = OrderedDict()  # id(item) -> (key, item), 最久没用的在前
+        self._in_use = {}  # id(item) -> key, 借出去还没还的
+        self._sizes = {}  # key -> 该 key 的资源总数(含借出和正在创建)
+        self._total = 0
+        self._waiters = deque()  # 全局 FIFO 的等待票据
+        self._warm = set()
+        self._closed = False
+
+    def acquire(self, key, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self._warm_up(key)
+        while True:
+            ticket = self._wait(key, deadline)
+            if ticket.victim is not None:
+                self._destroy(*ticket.victim)
+            if ticket.grant is _CREATE:
+                item = self._create(key)
+                with self._cond:
+                    self._in_use[id(item)] = key
+                return item
+            item = ticket.grant
+            if self.validate is None or self._try_validate(key, item):
+                return item
+            self._discard(key, item)
+
+    def _wait(self, key, deadline):
+        """排队等到一张发了东西的票据"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('pool is closed')
+            ticket = _Ticket(key)
+            self._waiters.append(ticket)
+            self._dispatch()
+            while ticket.grant is None:
+                if self._closed:
+                    self._waiters.remove(ticket)
+                    raise RuntimeError('pool is closed')
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self._waiters.remove(ticket)
+                    # 排头的走了, 后面被它挡住的可能可以拿名额了
+                    self._dispatch()
+                    raise queue.Empty
+                self._cond.wait(remaining)
+        return ticket
+
+    def release(self, key, item):
+        """还回来. 池子关了就直接销毁"""
+        with self._cond:
+            if self._in_use.get(id(item), _EMPTY) != key:
+                raise ValueError(f'{item!r} was not checked out from this pool under {key!r}')
+            del self._in_use[id(item)]
+            closed = self._closed
+            if closed:
+                self._sizes[key] -= 1
+                self._total -= 1
+            else:
+                self._idle.setdefault(key, deque()).append(item)
+                self._lru[id(item)] = (key, item)
+                self._dispatch()
+        if closed:
+            self._destroy(key, item)
+
+    def checkout(self, key):
+        """with pool.checkout(key) as item: ... 出了 with 一定还回池里"""
+        return ObjectPool(_KeyedQueue(self, key), auto_get=False)
+
+    def size(self, key=None):
+        return self._total if key is None else self._sizes.get(key, 0)
+
+    def idle(self, key=None):
+        if key is None:
+            return len(self._lru)
+        return len(self._idle.get(key, ()))
+
+    def close(self):
+        """销毁所有空闲资源, 借出去的在归还时销毁, 还在等的 acquire 抛 RuntimeError"""
+        with self._cond:
+            self._closed = True
+            idle = list(self._lru.values())
+            for key, item in idle:
+                self._forget(key, item)
+            self._cond.notify_all()
+        for key, item in idle:
+            self._destroy(key, item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _limits(self, key):
+        return self.limits.get(key, (self.min_per_key, self.max_per_key))
+
+    def _dispatch(self):
+        """按排队顺序发放: 本 key 的空闲资源, 或者一个新名额(必要时淘汰别人的空闲).
+        调用方持锁. 被淘汰的资源挂在票据上, 由拿到名额的线程在锁外销毁."""
+        if self._closed:
+            return
+        granted = False
+        global_blocked = False
+        for ticket in list(self._waiters):
+            key = ticket.key
+            idle = self._idle.get(key)
+            if idle:
+                item = idle.pop()
+                del self._lru[id(item)]
+                self._in_use[id(item)] = key
+                ticket.grant = item
+            elif global_blocked or self._sizes.get(key, 0) >= self._limits(key)[1]:
+                continue
+            else:
+                if self._total >= self.max_total:
+                    victim = self._lru_victim(key)
+                    if victim is None:
+                        # 排在前面的等不到名额, 后面的也不许插队抢名额
+                        global_blocked = True
+                        continue
+                    self._forget(*victim)
+                    ticket.victim = victim
+                ticket.grant = _CREATE
+                self._sizes[key] = self._sizes.get(key, 0) + 1
+                self._total += 1
+            self._waiters.remove(ticket)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _lru_victim(self, key):
+        for other, item in self._lru.values():
+            if other != key and self._sizes[other] > self._limits(other)[0]:
+                return other, item
+        return None
+
+    def _forget(self, key, item):
+        """把一个空闲资源从账上划掉(调用方持锁)"""
+        self._idle[key].remove(item)
+        del self._lru[id(item)]
+        self._sizes[key] -= 1
+        self._total -= 1
+
+    def _create(self, key):
+        try:
+            return self.factory(key)
+        except BaseException:
+            with self._cond:
+                self._sizes[key] -= 1
+                self._total -= 1
+                self._dispatch()
+            raise
+
+    def _destroy(self, key, item):
+        if self.destroy is not None:
+            self.destroy(key, item)
+
+    def _try_validate(self, key, item):
+        try:
+            return self.validate(key, item)
+        except Exception:
+            return False
+
+    def _discard(self, key, item):
+        """销毁一个借出去的资源并让出名额"""
+        with self._cond:
+            self._in_use.pop(id(item), None)
+            self._sizes[key] -= 1
+            self._total -= 1
+            self._dispatch()
+        self._destroy(key, item)
+
+    def _warm_up(self, key):
+        """第一次用到某个 key 时, 先造够 min 个放着(受全局上限约束)"""
+        if key in self._warm:
+            return
+        with self._cond:
+            if key in self._warm:
+                return
+            self._warm.add(key)
+            want = self._limits(key)[0] - self._sizes.get(key, 0)
+            want = max(0, min(want, self.max_total - self._total))
+            self._sizes[key] = self._sizes.get(key, 0) + want
+            self._total += want
+        made = 0
+        try:
+            for _ in range(want):
+                item = self._create(key)
+                made += 1
+                with self._cond:
+                    self._in_use[id(item)] = key
+                self.release(key, item)
+        except BaseException:
+            # 失败的那个名额 _create 已经退了, 还没造的也退回去; 下次用到再预热
+            with self._cond:
+                rest = want - made - 1
+                self._sizes[key] -= rest
+                self._total -= rest
+                self._warm.discard(key)
+                self._dispatch()
+            raise
+
+
+class _Ticket:
+    __slots__ = ('key', 'grant', 'victim')
+
+    def __init__(self, key):
+        self.key = key
+        self.grant = None  # None: 还在等; _CREATE: 拿到名额去造; 其他: 拿到的资源
+        self.victim = None  # 为了腾名额被淘汰的 (key, item), 由本票据的线程销毁
+
+
+class _KeyedQueue:
+    """把 KeyedResourcePool 的一个 key 伪装成队列, 好套 ObjectPool"""
+
+    def __init__(self, pool, key):
+        self._pool = pool
+        self._key = key
+
+    def get(self):
+        return self._pool.acquire(self._key)
+
+    def put(self, item):
+        self._pool.release(self._key, item)
+
+
+class SharedBufferPool:
+    """跨进程的缓冲区池: 一块 multiprocessing.shared_memory 切成等长的 slab
+
+    get() 借出一个 slab, 返回直接指向共享内存的 memoryview, 写进去不拷贝.
+    handle(view) 拿到 slab 的编号(就是个 int), 发给别的进程, 对方用
+    view(handle) 就能零拷贝地读写同一块内存, 用完 free(handle) 还回池里.
+    空闲 slab 的编号放在共享内存头部的一个栈里, 由一把进程锁保护, 再用一个
+    信号量计数, 没有空闲时 get() 可以阻塞等待. 头部还给每个 slab 留一个字节记着
+    借没借出, 重复 free 会抛 ValueError, 不会让两个人拿到同一个 slab.
+    池对象可以作为 Process 参数传给子进程(子进程里会按名字重新挂载).
+    """
+
+    def __init__(self, slab_size, count, ctx=None):
+        ctx = ctx or multiprocessing.get_context()
+        self.slab_size = slab_size
+        self.count = count
+        self._lock = ctx.Lock()
+        self._free = ctx.Semaphore(count)
+        self._shm = shared_memory.SharedMemory(create=True, size=self._base() + slab_size * count)
+        self._owner = os.getpid()  # fork 出来的子进程也会带着这个对象, 按 pid 认主
+        self._attach()
+        self._stack[0] = count
+        self._stack[1:] = array('i', range(count))
+
+    def _base(self):
+        # 头部: [栈顶, 空闲编号 * count] 的 int, 再每个 slab 一个借出标记字节,
+        # 之后的 slab 按 64 字节对齐
+        return (4 * (self.count + 1) + self.count + 63) & ~63
+
+    def _attach(self):
+        ints = 4 * (self.count + 1)
+        self._stack = self._shm.buf[:ints].cast('i')
+        self._in_use = self._shm.buf[ints:ints + self.count]
+        self._views = {}  # id(view) -> (编号, view), 本进程借出去的
+
+    def __getstate__(self):
+        return (self._shm.name, self.slab_size, self.count, self._lock, self._free)
+
+    def __setstate__(self, state):
+        name, self.slab_size, self.count, self._lock, self._free = state
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = None
+        self._attach()
+
+    def get(self, block=True, timeout=None):
+        if not self._free.acquire(block, timeout):
+            raise queue.Empty
+        with self._lock:
+            top = self._stack[0] - 1
+            self._stack[0] = top
+            handle = self._stack[1 + top]
+            self._in_use[handle] = 1
+        return self.view(handle)
+
+    def put(self, view, block=True, timeout=None):
+        self.free(self.handle(view))
+
+    def handle(self, view):
+        """本进程借出的 view -> slab 编号"""
+        return self._views[id(view)][0]
+
+    def view(self, handle):
+        """slab 编号 -> 指向共享内存的 memoryview, 哪个进程都能用"""
+        if not 0 <= handle < self.count:
+            raise ValueError(f'bad slab handle {handle}')
+        start = self._base() + handle * self.slab_size
+        view = self._shm.buf[start:start + self.slab_size]
+        self._views[id(view)] = (handle, view)
+        return view
+
+    def free(self, handle):
+        """把 slab 还回池里. 本进程里这个 slab 的 view 都会被 release, 防止误写.
+        没借出的 slab(重复 free)抛 ValueError, 什么都不动"""
+        if not 0 <= handle < self.count:
+            raise ValueError(f'bad slab handle {handle}')
+        with self._lock:
+            if not self._in_use[handle]:
+                raise ValueError(f'slab {handle} is not checked out')
+            self._in_use[handle] = 0
+            for key, (h, view) in list(self._views.items()):
+                if h == handle:
+                    del self._views[key]
+                    view.release()
+            top = self._stack[0]
+            self._stack[1 + top] = handle
+            self._stack[0] = top + 1
+        self._free.release()
+
+    def checkout(self):
+        """with pool.checkout() as view: ... 出了 with 一定还回池里"""
+        return ObjectPool(self, auto_get=False)
+
+    @property
+    def idle(self):
+        return self._stack[0]
+
+    def close(self):
+        """本进程不再使用; 创建者还会把共享内存 unlink 掉"""
+        for _, view in self._views.values():
+            view.release()
+        self._views.clear()
+        self._stack.release()
+        self._in_use.release()
+        self._shm.close()
+        if self._owner == os.getpid():
+            self._shm.unlink()
+
+
+def _upper_in_place(pool, handle):
+    """子进程里把 slab 里的字节改成大写, 演示零拷贝用"""
+    view = pool.view(handle)
+    view[:] = bytes(view).upper()
+    pool.close()
+
+
+def bench_thread_cache(items=8, ops=20000, max_threads=32):
+    """ObjectPool 套 queue.Queue vs 套 ThreadCachedPool, 线程数 1 -> 32"""
+
+    def run(source, threads):
+        def worker():
+            for _ in range(ops):
+                with ObjectPool(source, auto_get=False):
+                    pass
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        t0 = time.perf_counter()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        return threads * ops / (time.perf_counter() - t0)
+
+    threads = 1
+    while threads <= max_threads:
+        plain = queue.Queue()
+        cached = queue.Queue()
+        for i in range(max(items, threads)):
+            plain.put(i)
+            cached.put(i)
+        base = run(plain, threads)
+        fast = run(ThreadCachedPool(cached), threads)
+        print(f'{threads:>2} threads: queue {base:>10,.0f} ops/s, '
+              f'thread cache {fast:>10,.0f} ops/s, x{fast / base:.1f}')
+        threads *= 2
+
+
 def main():
     """
     >>> import queue
@@ -89,10 +1067,248 @@ def main():
     Inside func: yaya
     yaya
 
+    # ResourcePool: 有上限, 不够现造, 超时, 取出前验证
+    >>> made = []
+    >>> def connect():
+    ...     made.append(f'conn-{len(made)}')
+    ...     return made[-1]
+    >>> pool = ResourcePool(connect, min_size=1, max_size=2, timeout=0.05)
+    >>> pool.size, pool.idle
+    (1, 1)
+    >>> with pool.checkout() as a, pool.checkout() as b:
+    ...     pool.get()
+    Traceback (most recent call last):
+    ...
+    _queue.Empty
+    >>> pool.idle
+    2
+
+    # 验证失败的就地扔掉, 换一个
+    >>> pool.validate = lambda conn: conn != 'conn-1'
+    >>> with pool.checkout() as conn:
+    ...     conn
+    'conn-0'
+    >>> pool.validate = None
+
+    # 闲置太久的淘汰, 但至少留 min_size 个
+    >>> pool.max_idle = 0
+    >>> pool.evict(), pool.size
+    (1, 1)
+
+    # 超龄的也淘汰, 掉到 min_size 以下就补造
+    >>> pool.max_idle, pool.max_lifetime = None, 0
+    >>> pool.evict(), pool.size, pool.idle, made[-1]
+    (1, 1, 1, 'conn-2')
+    >>> pool.max_lifetime = None
+
+    # 64 个线程抢 4 个资源, 总数不会超过上限, 也不会丢
+    >>> import threading
+    >>> pool = ResourcePool(object, max_size=4)
+    >>> def worker():
+    ...     for _ in range(50):
+    ...         with pool.checkout():
+    ...             assert pool.size <= 4
+    >>> threads = [threading.Thread(target=worker) for _ in range(64)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> pool.size <= 4, pool.idle == pool.size
+    (True, True)
+
+    # 运行指标: 等待直方图, 持有时间分位数, 计数, 泄漏检测
+    >>> import warnings
+    >>> metrics = PoolMetrics(track_leaks=True)
+    >>> pool = ResourcePool(object, max_size=2, metrics=metrics)
+    >>> for _ in range(3):
+    ...     with pool.checkout():
+    ...         pass
+    >>> def leaky():
+    ...     ObjectPool(pool)     # 借了不还, 函数一结束就被 GC
+    >>> with warnings.catch_warnings(record=True) as caught:
+    ...     warnings.simplefilter('always')
+    ...     leaky()
+    >>> caught[0].category.__name__, 'in leaky' in metrics.leaks[0]['stack']
+    ('ResourceWarning', True)
+    >>> stats = pool.stats()
+    >>> stats['created'], stats['in_use'], stats['idle'], len(stats['leaks'])
+    (1, 0, 1, 1)
+    >>> stats['wait_histogram']['<=0.001'], stats['hold_p50'] < 1
+    (4, True)
+
+    # 验不过的只记 invalid, 关池子不算淘汰
+    >>> seen = []
+    >>> pool = ResourcePool(object, min_size=1, metrics=PoolMetrics(),
+    ...                     validate=lambda item: bool(seen) or seen.append(item))
+    >>> with pool.checkout():
+    ...     pass
+    >>> pool.close()
+    >>> {name: pool.metrics.counters[name] for name in ('created', 'invalid', 'evicted')}
+    {'created': 2, 'invalid': 1, 'evicted': 0}
+
+    # ThreadCachedPool: 线程本地缓存在前, 共享队列在后
+    >>> shared = queue.Queue()
+    >>> for name in ('yam', 'sam'):
+    ...     shared.put(name)
+    >>> fast = ThreadCachedPool(shared, cache_size=1)
+    >>> with ObjectPool(fast) as obj:
+    ...     obj
+    'yam'
+    >>> shared.qsize()   # 还回来的 yam 留在本线程缓存里
+    1
+    >>> with ObjectPool(fast) as obj:
+    ...     obj
+    'yam'
+
+    # 别的线程缓存里的也能偷回来
+    >>> t = threading.Thread(target=lambda: fast.put(fast.get()))
+    >>> t.start(); t.join()
+    >>> sorted([fast.get(), fast.get()])
+    ['sam', 'yam']
+    >>> fast.get(timeout=0)
+    Traceback (most recent call last):
+    ...
+    _queue.Empty
+
+    # KeyedResourcePool: 每个后端一个子池, 全局共用一个上限
+    >>> import itertools
+    >>> serial = itertools.count()
+    >>> hosts = KeyedResourcePool(lambda host: f'{host}#{next(serial)}', max_total=3,
+    ...                           max_per_key=2, min_per_key=1, timeout=0.05,
+    ...                           destroy=lambda host, conn: print('close', conn))
+    >>> with hosts.checkout('db') as conn:
+    ...     conn, hosts.size('db'), hosts.idle('db')
+    ('db#0', 1, 0)
+    >>> a, b = hosts.acquire('api'), hosts.acquire('api')
+    >>> a, b, hosts.size()
+    ('api#1', 'api#2', 3)
+
+    # 全局满了: cache 进来时淘汰最久没用的空闲资源(db 已经到 min 了, 不动它)
+    >>> hosts.release('api', a)
+    >>> cache = hosts.acquire('cache')
+    close api#1
+    >>> cache
+    'cache#3'
+    >>> hosts.acquire('api', timeout=0)
+    Traceback (most recent call last):
+    ...
+    _queue.Empty
+
+    # 只收借出去的: 还两次, 或者还到别的 key 下, 都不行
+    >>> hosts.release('api', b)
+    >>> hosts.release('api', b)
+    Traceback (most recent call last):
+    ...
+    ValueError: 'api#2' was not checked out from this pool under 'api'
+    >>> hosts.release('db', cache)
+    Traceback (most recent call last):
+    ...
+    ValueError: 'cache#3' was not checked out from this pool under 'db'
+
+    # 关池子: 空闲的当场销毁, 借出去的还回来时销毁, 之后不能再借
+    >>> hosts.close()
+    close db#0
+    close api#2
+    >>> hosts.release('cache', cache)
+    close cache#3
+    >>> hosts.size()
+    0
+    >>> hosts.acquire('db')
+    Traceback (most recent call last):
+    ...
+    RuntimeError: pool is closed
+
+    # 预热中途 factory 出错: 没造出来的名额全退回, 下次再预热
+    >>> flaky = iter([None, RuntimeError('down')])
+    >>> def connect(host):
+    ...     error = next(flaky, None)
+    ...     if error is not None:
+    ...         raise error
+    ...     return f'{host}#{next(serial)}'
+    >>> hosts = KeyedResourcePool(connect, max_total=4, min_per_key=3)
+    >>> hosts.acquire('db')
+    Traceback (most recent call last):
+    ...
+    RuntimeError: down
+    >>> hosts.size('db'), hosts.idle('db'), hosts.size()
+    (1, 1, 1)
+    >>> hosts.acquire('db'), hosts.size('db')
+    ('db#6', 3)
+
+    # validate: 断掉的连接借出前就发现, 销毁了换一个
+    >>> broken = set()
+    >>> with KeyedResourcePool(lambda host: f'{host}#{next(serial)}', max_total=2,
+    ...                        validate=lambda host, conn: conn not in broken,
+    ...                        destroy=lambda host, conn: print('close', conn)) as hosts:
+    ...     conn = hosts.acquire('db')
+    ...     hosts.release('db', conn)
+    ...     broken.add(conn)
+    ...     hosts.acquire('db'), hosts.size()
+    close db#7
+    ('db#8', 1)
+
+    # SharedBufferPool: 共享内存 slab, 进程间只传编号, 不拷贝数据
+    >>> buffers = SharedBufferPool(slab_size=8, count=2)
+    >>> with buffers.checkout() as view:
+    ...     view[:] = b'yam-sam!'
+    ...     handle = buffers.handle(view)
+    ...     worker = multiprocessing.Process(target=_upper_in_place, args=(buffers, handle))
+    ...     worker.start(); worker.join()
+    ...     bytes(view)
+    b'YAM-SAM!'
+    >>> a, b = buffers.get(), buffers.get()
+    >>> buffers.get(timeout=0)
+    Traceback (most recent call last):
+    ...
+    _queue.Empty
+    >>> freed = buffers.handle(b)
+    >>> buffers.put(a); buffers.free(freed); buffers.idle
+    2
+    >>> buffers.free(freed)  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: slab ... is not checked out
+    >>> buffers.idle, buffers.get() is not buffers.get()
+    (2, True)
+    >>> buffers.close()
+
+    # AsyncObjectPool: 协程版, 排队先来先得
+    >>> import asyncio
+    >>> async def demo():
+    ...     pool = AsyncObjectPool(['yam'])
+    ...     order = []
+    ...     async def user(name):
+    ...         async with pool.checkout() as obj:
+    ...             order.append(f'{name}:{obj}')
+    ...             await asyncio.sleep(0)
+    ...     await asyncio.gather(*(user(n) for n in 'abc'))
+    ...     return order
+    >>> asyncio.run(demo())
+    ['a:yam', 'b:yam', 'c:yam']
 
+    # 排队时被 cancel 的协程不会吞掉对象; async 的 factory/teardown
+    >>> async def demo():
+    ...     async def factory():
+    ...         return 'conn'
+    ...     async def teardown(item):
+    ...         print(f'teardown {item}')
+    ...     pool = AsyncObjectPool(factory=factory, teardown=teardown, max_size=1)
+    ...     item = await pool.get()
+    ...     waiter = asyncio.create_task(pool.get())
+    ...     await asyncio.sleep(0)
+    ...     pool.put(item)   # 交到 waiter 手上, 但它还没来得及运行
+    ...     waiter.cancel()
+    ...     await asyncio.gather(waiter, return_exceptions=True)
+    ...     print(pool.size, pool.idle)
+    ...     await pool.aclose()
+    >>> asyncio.run(demo())
+    1 1
+    teardown conn
     """
 
 
 if __name__ == "__main__":
-    import doctest
-    doctest.testmod(verbose=False)
+    import sys
+    if '--bench' in sys.argv:
+        bench_thread_cache()
+    else:
+        import doctest
+        doctest.testmod(verbose=False)
@@ -19,6 +19,32 @@
     +----------------------+ n |     | message_center.update() |
         +----------------------+     +-------------------------+
 
+*主题通配
+主题按 '.' 分层, 订阅时可以用通配: '*' 匹配恰好一层, '#' 匹配零层或多层,
+比如 'orders.*' 收 'orders.new', 'orders.#' 还收 'orders' 和 'orders.eu.new'.
+带通配的订阅放进一棵按层展开的主题树, 发布时顺着主题一层层往下走, 代价只跟
+主题的层数有关, 跟有多少订阅无关. 不带通配的订阅还是放在原来的 dict 里, 一次查完.
+同一条消息, 一个订阅者就算命中了好几个模式也只收一次.
+
+*订阅表
+每个主题的订阅者放在一个 dict 里当有序集合用(订阅者 -> 订阅者), 按订阅先后发送,
+订阅/退订都是 O(1), 重复订阅只算一次. subscribe(..., weak=True) 只存弱引用,
+订阅者没人用了被回收, 它的订阅也跟着自动删掉, 不会再收到 run().
+
+*线程池分发
+订阅者的 run 常常是阻塞 I/O, 串行挨个调就是所有人的耗时加起来. Provider 给一个
+executor(比如 ThreadPoolExecutor)时, update() 先把这一轮的消息按订阅者分好组,
+每个订阅者一个任务, 任务里按发布顺序挨个 run: 同一个订阅者看到的顺序不变,
+不同订阅者在不同线程里同时跑, 整轮耗时差不多就是最慢那个订阅者的耗时.
+
+*asyncio 版
+Provider.update() 一口气把消息挨个交给每个订阅者, 一个慢的拖住所有人.
+AsyncProvider 给每个订阅者一个有界的 asyncio.Queue 和一个自己的消费任务, 发布
+只是往各个队列里放. 队列满了怎么办由 overflow 决定:
+- 'block': 发布方等着, 慢订阅者的背压一路传回发布方
+- 'drop-oldest': 扔掉队列里最老的一条, 新的放进去
+- 'drop-newest': 扔掉这条新的
+stats(subscriber) 给出每个订阅者积压了多少, 扔了多少, 消息排队等了多久.
 
 *大内参
 http://www.slideshare.net/ishraqabd/publish-subscribe-model-overview-13368808
@@ -26,34 +52,346 @@ Author: https://github.com/HanWenfan
 
 """
 
+import asyncio
+import concurrent.futures
+import functools
+import inspect
+import random
+import sys
+import time
+import weakref
+from collections import deque
+
+
+class _TopicNode:
+    """主题树的一个节点: 下一层的词 -> 子节点, 加上模式正好到这一层结束的订阅者"""
+
+    __slots__ = ('children', 'subscribers')
 
-class Provider:
     def __init__(self):
+        self.children = {}
+        self.subscribers = {}
+
+
+def _is_pattern(msg):
+    return '*' in msg or '#' in msg
+
+
+def _weak_key(subscriber):
+    """拿来在订阅表里查弱引用那一项; 不能弱引用的订阅者返回 None"""
+    try:
+        return weakref.ref(subscriber)
+    except TypeError:
+        return None
+
+
+def _live(table):
+    """订阅表里活着的订阅者. 先整个拷出来, 回调里退订/被回收都不影响这一轮"""
+    subs = []
+    for sub in list(table.values()):
+        if type(sub) is weakref.ref:
+            sub = sub()
+            if sub is None:
+                continue
+        subs.append(sub)
+    return subs
+
+
+class Provider:
+    def __init__(self, executor=None):
+        # executor: 有的话 update() 把订阅者的回调分到它上面并行跑
+        self.executor = executor
         self.msg_queue = []
+        # 精确主题 -> 订阅者; 带通配的订阅在主题树 _patterns 里
         self.subscribers = {}
+        self._patterns = _TopicNode()
 
     def notify(self, msg):
         self.msg_queue.append(msg)
 
-    def subscribe(self, msg, subscriber):
-        self.subscribers.setdefault(msg, []).append(subscriber)
+    def subscribe(self, msg, subscriber, weak=False):
+        if not _is_pattern(msg):
+            table = self.subscribers.setdefault(msg, {})
+        else:
+            node = self._patterns
+            for word in msg.split('.'):
+                node = node.children.setdefault(word, _TopicNode())
+            table = node.subscribers
+        # 一个订阅者在一张表里只占一项: 强弱换着订阅时, 把另一种的那项换掉
+        if weak:
+            table.pop(subscriber, None)
+            # 弱引用的 hash 跟着订阅者走, 但它只和弱引用比相等(ref == subscriber 是 False),
+            # 所以拿订阅者本身查不到这一项; 退订时要用 _weak_key 另造一个弱引用去查
+            ref = weakref.ref(subscriber, functools.partial(self._forget, msg))
+            table.setdefault(ref, ref)
+        else:
+            ref = _weak_key(subscriber)
+            if ref is not None:
+                table.pop(ref, None)
+            table[subscriber] = subscriber
 
     def unsubscribe(self, msg, subscriber):
-        self.subscribers[msg].remove(subscriber)
+        path = None
+        if not _is_pattern(msg):
+            table = self.subscribers.get(msg, {})
+        else:
+            path = self._path(msg)
+            table = path[-1].subscribers if path else {}
+        if table.pop(subscriber, None) is None:
+            ref = _weak_key(subscriber)
+            if ref is None or table.pop(ref, None) is None:
+                raise ValueError(f'{subscriber!r} is not subscribed to {msg!r}')
+        self._prune(msg, table, path)
+
+    def _forget(self, msg, ref):
+        """弱引用订阅者被回收时的回调: 把它从订阅表里删掉"""
+        path = None
+        if not _is_pattern(msg):
+            table = self.subscribers.get(msg, {})
+        else:
+            path = self._path(msg)
+            table = path[-1].subscribers if path else {}
+        # 订阅者已经死了, 弱引用只跟自己相等, 按身份删
+        if table.pop(ref, None) is not None:
+            self._prune(msg, table, path)
+
+    def _path(self, msg):
+        """模式在主题树上从根往下的节点, 没有这条路径返回 None"""
+        path = [self._patterns]
+        for word in msg.split('.'):
+            node = path[-1].children.get(word)
+            if node is None:
+                return None
+            path.append(node)
+        return path
+
+    def _prune(self, msg, table, path):
+        """退订后订阅表空了就删掉, 主题树顺路剪掉空分支, 免得只增不减"""
+        if table:
+            return
+        if path is None:
+            self.subscribers.pop(msg, None)
+            return
+        for parent, word, node in zip(reversed(path[:-1]), reversed(msg.split('.')), reversed(path)):
+            if node.subscribers or node.children:
+                break
+            del parent.children[word]
+
+    def _match(self, msg):
+        """沿主题树往下走, 找出所有模式能匹配 msg 的订阅者"""
+        words = msg.split('.')
+        found = []
+        stack = [(self._patterns, 0)]
+        while stack:
+            node, i = stack.pop()
+            rest = node.children.get('#')
+            if rest is not None:
+                # '#' 吃掉后面 0 到全部的词
+                stack.extend((rest, j) for j in range(i, len(words) + 1))
+            if i == len(words):
+                found.extend(_live(node.subscribers))
+                continue
+            for word in (words[i], '*'):
+                child = node.children.get(word)
+                if child is not None:
+                    stack.append((child, i + 1))
+        return found
+
+    def subscribers_of(self, msg):
+        table = self.subscribers.get(msg)
+        exact = _live(table) if table else []
+        # 没有任何通配订阅: 还是原来那一次 dict 查找
+        if not self._patterns.children:
+            return exact
+        wild = self._match(msg)
+        if not wild:
+            return exact
+        return list(dict.fromkeys(exact + wild))
 
     def update(self):
+        if self.executor is not None:
+            return self._fan_out()
         for msg in self.msg_queue:
-            for sub in self.subscribers.get(msg, []):
+            for sub in self.subscribers_of(msg):
                 sub.run(msg)
         self.msg_queue = []
 
+    def _fan_out(self):
+        """一个订阅者一个任务, 任务里按发布顺序送它的那些消息.
+        回调里新 notify 的消息留到下一轮. 有回调出错时, 等所有任务跑完再把第一个
+        错误抛出来; 这一轮的消息已经送过了, 不会留在队列里重发."""
+        msgs, self.msg_queue = self.msg_queue, []
+        batches = {}
+        for msg in msgs:
+            for sub in self.subscribers_of(msg):
+                batches.setdefault(sub, []).append(msg)
+        futures = [self.executor.submit(_deliver, sub, batch) for sub, batch in batches.items()]
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+
+def _deliver(subscriber, msgs):
+    for msg in msgs:
+        subscriber.run(msg)
+
+
+class _Mailbox:
+    """一个订阅者在 AsyncProvider 里的信箱: 有界队列, 消费任务, 计数"""
+
+    __slots__ = ('subscriber', 'queue', 'queued_at', 'overflow', 'task', 'topics',
+                 'delivered', 'dropped', 'errors', 'max_lag')
+
+    def __init__(self, subscriber, maxsize, overflow):
+        self.subscriber = subscriber
+        self.queue = asyncio.Queue(maxsize)
+        # 队列里每条消息的入队时间, 顺序和队列一致, 队头就是最老那条
+        self.queued_at = deque()
+        self.overflow = overflow
+        self.task = None
+        self.topics = set()
+        self.delivered = self.dropped = self.errors = 0
+        self.max_lag = 0.0
+
+
+_OVERFLOW = ('block', 'drop-oldest', 'drop-newest')
+
+
+class AsyncProvider:
+    """asyncio 版消息中心: 每个订阅者一个有界队列和一个消费任务, 互不拖累
+
+    - maxsize, overflow: 订阅者信箱的默认容量和满了之后的策略, subscribe 时可以单独指定
+    - 订阅者的 run 可以是普通函数, 也可以是 async 函数
+    - 主题匹配(含通配)和 Provider 一样, 路由就是交给一个 Provider 做的
+    subscribe 要在事件循环里调用, 因为要起消费任务.
+    """
+
+    def __init__(self, maxsize=100, overflow='block'):
+        if overflow not in _OVERFLOW:
+            raise ValueError(f'overflow must be one of {_OVERFLOW}')
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._router = Provider()
+        self._mailboxes = {}
+        # 退订后等着送完积压再停的信箱; asyncio 只弱引用任务, 这里要攥住
+        self._retiring = set()
+        # 还在送积压的信箱: 订阅者 -> (信箱, 停它的任务). 这期间又订回来就接着用
+        self._leaving = {}
+
+    def subscribe(self, msg, subscriber, weak=False, maxsize=None, overflow=None):
+        if weak:
+            raise ValueError("AsyncProvider can't hold weak subscribers: "
+                             "the consumer task keeps its subscriber alive")
+        box = self._mailboxes.get(subscriber)
+        if box is None and subscriber in self._leaving:
+            # 退订后积压还没送完又订回来: 不停了, 接着用原来的信箱和消费任务,
+            # 不然新旧两个消费任务同时在跑, 消息顺序就乱了
+            box, task = self._leaving.pop(subscriber)
+            task.cancel()
+            self._mailboxes[subscriber] = box
+        if box is None:
+            overflow = self.overflow if overflow is None else overflow
+            if overflow not in _OVERFLOW:
+                raise ValueError(f'overflow must be one of {_OVERFLOW}')
+            box = _Mailbox(subscriber, self.maxsize if maxsize is None else maxsize, overflow)
+            box.task = asyncio.get_running_loop().create_task(self._consume(box))
+            self._mailboxes[subscriber] = box
+        self._router.subscribe(msg, subscriber)
+        box.topics.add(msg)
+
+    def unsubscribe(self, msg, subscriber):
+        self._router.unsubscribe(msg, subscriber)
+        box = self._mailboxes[subscriber]
+        box.topics.discard(msg)
+        if not box.topics:
+            # 信箱里已经收下的消息照样送完, 然后再停掉消费任务
+            del self._mailboxes[subscriber]
+            task = asyncio.get_running_loop().create_task(self._retire(box))
+            self._retiring.add(task)
+            task.add_done_callback(self._retiring.discard)
+            self._leaving[subscriber] = (box, task)
+
+    async def notify(self, msg):
+        now = asyncio.get_running_loop().time()
+        for sub in self._router.subscribers_of(msg):
+            # 前面的订阅者满了要等, 等的时候后面的订阅者可能已经退订了
+            box = self._mailboxes.get(sub)
+            if box is None:
+                continue
+            queue = box.queue
+            if not queue.full():
+                queue.put_nowait((msg, now))
+            elif box.overflow == 'block':
+                await queue.put((msg, now))
+            elif box.overflow == 'drop-oldest':
+                queue.get_nowait()
+                queue.task_done()
+                box.queued_at.popleft()
+                box.dropped += 1
+                queue.put_nowait((msg, now))
+            else:
+                box.dropped += 1
+                continue
+            box.queued_at.append(now)
+
+    async def _consume(self, box):
+        loop = asyncio.get_running_loop()
+        while True:
+            msg, queued_at = await box.queue.get()
+            box.queued_at.popleft()
+            box.max_lag = max(box.max_lag, loop.time() - queued_at)
+            try:
+                result = box.subscriber.run(msg)
+                if inspect.isawaitable(result):
+                    await result
+                box.delivered += 1
+            except Exception:
+                # 一个订阅者出错不能让它的消费任务就此停掉, 记下来接着收
+                box.errors += 1
+            finally:
+                box.queue.task_done()
+
+    async def _retire(self, box):
+        await box.queue.join()
+        # 从这里起停定了, subscribe 不会再把它接回去
+        del self._leaving[box.subscriber]
+        box.task.cancel()
+        await asyncio.gather(box.task, return_exceptions=True)
+
+    def stats(self, subscriber):
+        """订阅者的信箱状况: pending 积压条数, delivered/dropped/errors 计数,
+        lag 最老那条积压消息等了几秒, max_lag 消息从发布到开始处理最长等过几秒"""
+        box = self._mailboxes[subscriber]
+        lag = 0.0
+        if box.queued_at:
+            lag = asyncio.get_running_loop().time() - box.queued_at[0]
+        return {'pending': box.queue.qsize(), 'delivered': box.delivered,
+                'dropped': box.dropped, 'errors': box.errors,
+                'lag': lag, 'max_lag': box.max_lag}
+
+    async def join(self):
+        """等所有信箱里的消息都处理完"""
+        for box in list(self._mailboxes.values()):
+            await box.queue.join()
+
+    async def close(self):
+        """处理完积压的消息, 停掉所有消费任务"""
+        await self.join()
+        boxes = list(self._mailboxes.values())
+        self._mailboxes.clear()
+        for box in boxes:
+            box.task.cancel()
+        await asyncio.gather(*(box.task for box in boxes), *self._retiring,
+                             return_exceptions=True)
+
 
 class Publisher:
     def __init__(self, msg_center):
         self.provider = msg_center
 
     def publish(self, msg):
-        self.provider.notify(msg)
+        # 消息中心是 AsyncProvider 时, 返回的协程交给调用方 await
+        return self.provider.notify(msg)
 
 
 class Subscriber:
@@ -61,8 +399,8 @@ class Subscriber:
         self.name = name
         self.provider = msg_center
 
-    def subscribe(self, msg):
-        self.provider.subscribe(msg, self)
+    def subscribe(self, msg, weak=False):
+        self.provider.subscribe(msg, self, weak)
 
     def unsubscribe(self, msg):
         self.provider.unsubscribe(msg, self)
@@ -71,6 +409,67 @@ class Subscriber:
         print(f'{self.name} got {msg}')
 
 
+def bench_churn(n=100000, topics=10):
+    """n 个订阅者订阅再乱序退订: 原来的 list 订阅表 vs 现在的 dict 订阅表"""
+    subs = [object() for _ in range(n)]
+    order = subs[:]
+    random.Random(1).shuffle(order)
+
+    t0 = time.perf_counter()
+    tables = {}
+    for i, sub in enumerate(subs):
+        tables.setdefault(i % topics, []).append(sub)
+    index = {id(sub): i for i, sub in enumerate(subs)}
+    for sub in order:
+        tables[index[id(sub)] % topics].remove(sub)
+    old = time.perf_counter() - t0
+
+    provider = Provider()
+    t0 = time.perf_counter()
+    for i, sub in enumerate(subs):
+        provider.subscribe(f'topic{i % topics}', sub)
+    for sub in order:
+        provider.unsubscribe(f'topic{index[id(sub)] % topics}', sub)
+    new = time.perf_counter() - t0
+    print(f'{n:,} subscribe+unsubscribe over {topics} topics: '
+          f'list {old:.2f}s, dict {new:.2f}s ({old / new:.0f}x)')
+
+    provider = Provider()
+    alive = [Subscriber(i, provider) for i in range(n)]
+    t0 = time.perf_counter()
+    for sub in alive:
+        sub.subscribe(f'topic{sub.name % topics}', weak=True)
+    del alive, sub
+    print(f'{n:,} weak subscribers dropped: {len(provider.subscribers)} topics left, '
+          f'{time.perf_counter() - t0:.2f}s')
+
+
+def bench_fanout(subscribers=8, messages=20, delay=0.001, slow_delay=0.01):
+    """一个慢订阅者加一群阻塞 I/O 订阅者: 串行 update() vs 线程池 update()"""
+
+    class Sleeper:
+        def __init__(self, delay):
+            self.delay = delay
+
+        def run(self, msg):
+            time.sleep(self.delay)
+
+    for executor in (None, concurrent.futures.ThreadPoolExecutor(subscribers)):
+        provider = Provider(executor)
+        provider.subscribe('tick', Sleeper(slow_delay))
+        for _ in range(subscribers - 1):
+            provider.subscribe('tick', Sleeper(delay))
+        for _ in range(messages):
+            provider.notify('tick')
+        t0 = time.perf_counter()
+        provider.update()
+        elapsed = time.perf_counter() - t0
+        name = 'serial' if executor is None else f'{subscribers} threads'
+        print(f'{name:>10}: drained {messages} messages x {subscribers} subscribers in {elapsed:.3f}s')
+        if executor is not None:
+            executor.shutdown()
+
+
 def main():
     """
     >>> message_center = Provider()
@@ -107,9 +506,186 @@ def main():
     Jack got music
     Hebe got movie
     Hebe got movie
+
+    # 主题通配: '*' 一层, '#' 零层或多层
+    >>> shop = Provider()
+    >>> orders = Publisher(shop)
+    >>> ops = Subscriber('Ops', shop)
+    >>> ops.subscribe('orders.#')
+    >>> clerk = Subscriber('Clerk', shop)
+    >>> clerk.subscribe('orders.*')
+    >>> clerk.subscribe('orders.*.paid')
+    >>> clerk.subscribe('orders.new')
+
+    >>> for topic in ('orders', 'orders.new', 'orders.eu.paid', 'users.new'):
+    ...     orders.publish(topic)
+    >>> shop.update()
+    Ops got orders
+    Clerk got orders.new
+    Ops got orders.new
+    Clerk got orders.eu.paid
+    Ops got orders.eu.paid
+
+    >>> clerk.unsubscribe('orders.*.paid')
+    >>> ops.unsubscribe('orders.#')
+    >>> list(shop._patterns.children['orders'].children)
+    ['*']
+
+    # 订阅表是有序集合: 重复订阅只算一次, 退订 O(1)
+    >>> news = Provider()
+    >>> anchor = Publisher(news)
+    >>> tom = Subscriber('Tom', news)
+    >>> tom.subscribe('news')
+    >>> tom.subscribe('news')
+    >>> tom.unsubscribe('news')
+    >>> tom.unsubscribe('news')  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: <...Subscriber object at ...> is not subscribed to 'news'
+
+    # weak=True: 订阅者被回收, 订阅自动消失
+    >>> ghost = Subscriber('Ghost', news)
+    >>> ghost.subscribe('news', weak=True)
+    >>> ghost.subscribe('news.#', weak=True)
+    >>> tom.subscribe('news')
+    >>> anchor.publish('news')
+    >>> news.update()
+    Ghost got news
+    Tom got news
+    >>> del ghost
+    >>> anchor.publish('news')
+    >>> news.update()
+    Tom got news
+    >>> list(news.subscribers), news._patterns.children
+    (['news'], {})
+
+    # 强弱换着订阅同一个主题, 还是只收一次
+    >>> tom.subscribe('news', weak=True)
+    >>> tom.subscribe('news')
+    >>> anchor.publish('news')
+    >>> news.update()
+    Tom got news
+    >>> len(news.subscribers['news'])
+    1
+
+    # 线程池分发: 不同订阅者并行, 同一个订阅者按发布顺序
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> class Logger(Subscriber):
+    ...     def __init__(self, name, msg_center, delay):
+    ...         super().__init__(name, msg_center)
+    ...         self.delay, self.log = delay, []
+    ...     def run(self, msg):
+    ...         time.sleep(self.delay)
+    ...         self.log.append(msg)
+
+    >>> with ThreadPoolExecutor(4) as executor:
+    ...     studio = Provider(executor)
+    ...     radio = Publisher(studio)
+    ...     loggers = [Logger(name, studio, delay) for name, delay in (('a', 0.005), ('b', 0), ('c', 0.001))]
+    ...     for logger in loggers:
+    ...         logger.subscribe('song.#')
+    ...     loggers[1].subscribe('talk')
+    ...     for topic in ('song.1', 'talk', 'song.2', 'song.3'):
+    ...         radio.publish(topic)
+    ...     studio.update()
+    >>> [logger.log for logger in loggers]
+    [['song.1', 'song.2', 'song.3'], ['song.1', 'talk', 'song.2', 'song.3'], ['song.1', 'song.2', 'song.3']]
+    >>> studio.msg_queue
+    []
+
+    # asyncio 版: 每个订阅者一个有界信箱, 慢的只拖累自己
+    >>> import asyncio
+    >>> class Slow(Subscriber):
+    ...     def __init__(self, name, msg_center):
+    ...         super().__init__(name, msg_center)
+    ...         self.inbox = []
+    ...     async def run(self, msg):
+    ...         await asyncio.sleep(0.01)
+    ...         self.inbox.append(msg)
+
+    >>> async def broadcast():
+    ...     hub = AsyncProvider(maxsize=10)
+    ...     tv = Publisher(hub)
+    ...     fast = Subscriber('Fast', hub)
+    ...     fast.subscribe('news.*')
+    ...     latest = Slow('Latest', hub)
+    ...     hub.subscribe('news.*', latest, maxsize=2, overflow='drop-oldest')
+    ...     first = Slow('First', hub)
+    ...     hub.subscribe('news.*', first, maxsize=2, overflow='drop-newest')
+    ...     for i in range(5):
+    ...         await tv.publish(f'news.{i}')
+    ...     print({sub.name: hub.stats(sub)['pending'] for sub in (fast, latest, first)})
+    ...     await hub.join()
+    ...     for sub in (latest, first):
+    ...         stats = hub.stats(sub)
+    ...         print(sub.name, sub.inbox, stats['delivered'], stats['dropped'])
+    ...     await hub.close()
+    >>> asyncio.run(broadcast())
+    {'Fast': 5, 'Latest': 2, 'First': 2}
+    Fast got news.0
+    Fast got news.1
+    Fast got news.2
+    Fast got news.3
+    Fast got news.4
+    Latest ['news.3', 'news.4'] 2 3
+    First ['news.0', 'news.1'] 2 3
+
+    # 'block': 信箱满了发布方就等着, 一条不丢, 代价是发布变慢, 消息排队变久
+    >>> async def backpressure():
+    ...     hub = AsyncProvider(maxsize=1, overflow='block')
+    ...     slow = Slow('Slow', hub)
+    ...     slow.subscribe('news')
+    ...     loop = asyncio.get_running_loop()
+    ...     start = loop.time()
+    ...     for _ in range(4):
+    ...         await hub.notify('news')
+    ...     waited = loop.time() - start
+    ...     stats = hub.stats(slow)
+    ...     await hub.close()
+    ...     return waited >= 0.02, stats['pending'], stats['dropped'], stats['max_lag'] > 0, len(slow.inbox)
+    >>> asyncio.run(backpressure())
+    (True, 1, 0, True, 4)
+
+    # 发布方卡在一个满了的信箱上时, 后面的订阅者退订了: 跳过它, 它已收下的照样送完
+    >>> async def leave_while_blocked():
+    ...     hub = AsyncProvider(maxsize=1, overflow='block')
+    ...     first, second = Slow('First', hub), Slow('Second', hub)
+    ...     first.subscribe('news')
+    ...     second.subscribe('news')
+    ...     await hub.notify('news')
+    ...     await asyncio.sleep(0)  # 两个消费任务各取走一条, 正在慢慢处理
+    ...     await hub.notify('news')  # 两个信箱又都满了
+    ...     publishing = asyncio.ensure_future(hub.notify('news'))
+    ...     await asyncio.sleep(0)  # 发布方卡在 first 上
+    ...     second.unsubscribe('news')
+    ...     await publishing
+    ...     await hub.close()
+    ...     return len(first.inbox), len(second.inbox), len(hub._retiring)
+    >>> asyncio.run(leave_while_blocked())
+    (3, 2, 0)
+
+    # 退订后积压还没送完就订回来: 接着用原来的信箱, 不会有两个消费任务抢着送
+    >>> async def rejoin():
+    ...     hub = AsyncProvider()
+    ...     slow = Slow('Slow', hub)
+    ...     slow.subscribe('news')
+    ...     for _ in range(3):
+    ...         await hub.notify('news')
+    ...     slow.unsubscribe('news')
+    ...     slow.subscribe('news')
+    ...     await hub.notify('news')
+    ...     await hub.join()
+    ...     stats = hub.stats(slow)
+    ...     await hub.close()
+    ...     return len(slow.inbox), stats['delivered'], len(hub._retiring)
+    >>> asyncio.run(rejoin())
+    (4, 4, 0)
 """
 
 if __name__ == "__main__":
-    # main()
-    import doctest
-    doctest.testmod(verbose=True)
+    if '--bench' in sys.argv:
+        bench_churn()
+        bench_fanout()
+    else:
+        import doctest
+        doctest.testmod(verbose=True)